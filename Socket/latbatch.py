@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2007 Carnegie Mellon University
+#
+# You may copy and modify this freely under the same terms as
+# Sphinx-III
+
+"""
+Batch processing of word lattices.
+
+Runs a pipeline of L{lattice.Dag} operations over many lattice files
+in parallel, writing one JSON record per utterance, for example::
+
+    latbatch.py -j 8 -o results.jsonl --lm model/mobile.lm.DMP lattice/
+
+Each record contains the file name and utterance ID, the size of the
+lattice, the best hypothesis (without fillers or sentence markers), the
+log posterior probability of each hypothesis word, and the time in
+seconds taken by each step.  If lattices are pruned, the record also
+contains their size before pruning.  Lattices which fail to process produce a
+record with an C{error} field instead.
+"""
+
+import sys
+import os
+import glob
+import time
+import optparse
+import multiprocessing
+import json
+import itertools
+
+import lattice
+
+# Steps which may appear in a pipeline (they always run in this order,
+# except that posteriors are computed before the best path is traced).
+# All but 'prune' are run by default.
+STEPS = ('load', 'bypass_fillers', 'remove_unreachable', 'prune',
+         'bestpath', 'posterior')
+
+# Per-process state, set up by init_worker()
+worker = {}
+
+def init_worker(steps, lmfile=None, lw=1.0, aw=1.0, frate=100,
+                beam=10.0, max_edges=None):
+    """
+    Initialize a worker process, loading the language model if any.
+    """
+    worker['steps'] = steps
+    worker['lw'] = lw
+    worker['aw'] = aw
+    worker['frate'] = frate
+    worker['beam'] = beam
+    worker['max_edges'] = max_edges
+    worker['lm'] = None
+    if lmfile:
+        import sphinxbase
+        worker['lm'] = lattice.CachedLM(sphinxbase.NGramModel(lmfile))
+
+def load(latfile, frate=100):
+    """
+    Load a lattice, choosing the format from the file name.
+
+    @param latfile: Lattice file (C{.latb} for binary, C{.slf} or
+                    C{.slf.gz} for HTK, anything else for Sphinx-III)
+    @type latfile: string
+    @rtype: lattice.Dag
+    """
+    if latfile.endswith('.latb'):
+        return lattice.ArrayDag(binary_file=latfile).array2dag()
+    elif latfile.endswith('.slf') or latfile.endswith('.slf.gz'):
+        return lattice.Dag(htk_file=latfile, frate=frate)
+    else:
+        return lattice.Dag(sphinx_file=latfile, frate=frate)
+
+def uttid(latfile):
+    """
+    Return the utterance ID for a lattice file (its base name with
+    any extensions removed).
+    """
+    return os.path.basename(latfile).split('.')[0]
+
+def process(latfile):
+    """
+    Run the pipeline on a single lattice.
+
+    @param latfile: Lattice file
+    @type latfile: string
+    @return: Result record
+    @rtype: dict
+    """
+    steps = worker['steps']
+    lm = worker['lm']
+    record = {'file': latfile, 'uttid': uttid(latfile)}
+    timing = record['timing'] = {}
+    try:
+        t = time.time()
+        dag = load(latfile, worker['frate'])
+        timing['load'] = time.time() - t
+        if 'bypass_fillers' in steps:
+            t = time.time()
+            dag.bypass_fillers(lm)
+            timing['bypass_fillers'] = time.time() - t
+        if 'remove_unreachable' in steps:
+            t = time.time()
+            dag.remove_unreachable()
+            timing['remove_unreachable'] = time.time() - t
+        if 'prune' in steps:
+            t = time.time()
+            sizes = dag.prune(worker['beam'], lm, worker['lw'], worker['aw'],
+                              worker['max_edges'])
+            timing['prune'] = time.time() - t
+            record['unpruned_nodes'] = sizes[0]
+            record['unpruned_edges'] = sizes[1]
+        record['n_nodes'] = dag.n_nodes()
+        record['n_edges'] = dag.n_edges()
+        if 'posterior' in steps:
+            t = time.time()
+            dag.posterior(lm, worker['lw'], worker['aw'])
+            timing['posterior'] = time.time() - t
+        if 'bestpath' in steps:
+            t = time.time()
+            end = dag.bestpath(lm)
+            timing['bestpath'] = time.time() - t
+            if end == None:
+                raise ValueError("No path to final node")
+            record['score'] = end.score
+            words = []
+            posts = []
+            path = dag.backtrace(end)
+            for u, v in zip(path[:-1], path[1:]):
+                if lattice.symtab.filler[u.wid] or lattice.symtab.sentmark[u.wid]:
+                    continue
+                words.append(lattice.symtab.basesym[u.wid])
+                if 'posterior' in steps:
+                    posts.append(max([x.post for x in u.exits if x.dest == v]))
+            record['hyp'] = " ".join(words)
+            if 'posterior' in steps:
+                record['posteriors'] = posts
+    except Exception, e:
+        record['error'] = "%s: %s" % (e.__class__.__name__, e)
+    return record
+
+def find_lattices(args):
+    """
+    Expand command-line arguments (files, directories or glob
+    patterns) into a sorted list of lattice files.
+    """
+    files = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for pattern in ('*.lat', '*.lat.gz', '*.latb', '*.slf', '*.slf.gz'):
+                files.extend(glob.glob(os.path.join(arg, pattern)))
+        elif os.path.exists(arg):
+            files.append(arg)
+        else:
+            files.extend(glob.glob(arg))
+    files.sort()
+    return files
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] LATTICE|DIRECTORY|GLOB...")
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="Write JSON records to FILE (default: stdout)")
+    parser.add_option('-j', '--jobs', type='int', default=0,
+                      help="Number of worker processes (default: number of CPUs)")
+    parser.add_option('-s', '--steps',
+                      default=",".join([s for s in STEPS if s != 'prune']),
+                      help="Comma-separated pipeline steps (default: %default)")
+    parser.add_option('--lm', metavar='FILE',
+                      help="Language model for filler bypass, search and posteriors")
+    parser.add_option('--lw', type='float', default=1.0,
+                      help="Language model weight for posteriors (default: %default)")
+    parser.add_option('--aw', type='float', default=1.0,
+                      help="Acoustic weight for posteriors (default: %default)")
+    parser.add_option('--beam', type='float', default=10.0,
+                      help="Posterior beam for pruning (default: %default)")
+    parser.add_option('--max-edges', type='int',
+                      help="Maximum links starting in each frame after pruning")
+    parser.add_option('--frate', type='int', default=100,
+                      help="Frame rate for HTK lattices (default: %default)")
+    parser.add_option('--chunksize', type='int', default=8,
+                      help="Lattices per task sent to each worker (default: %default)")
+    opts, args = parser.parse_args(argv)
+    steps = [s.strip() for s in opts.steps.split(',') if s.strip()]
+    for s in steps:
+        if s not in STEPS:
+            parser.error("Unknown step %s (choose from %s)" % (s, ", ".join(STEPS)))
+    files = find_lattices(args)
+    if not files:
+        parser.error("No lattices found")
+    if opts.output:
+        out = open(opts.output, 'w')
+    else:
+        out = sys.stdout
+    initargs = (steps, opts.lm, opts.lw, opts.aw, opts.frate,
+                opts.beam, opts.max_edges)
+    t = time.time()
+    nerr = 0
+    if opts.jobs == 1:
+        init_worker(*initargs)
+        results = itertools.imap(process, files)
+    else:
+        pool = multiprocessing.Pool(opts.jobs or None, init_worker, initargs)
+        results = pool.imap(process, files, opts.chunksize)
+    for record in results:
+        if 'error' in record:
+            nerr += 1
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+    if opts.jobs != 1:
+        pool.close()
+        pool.join()
+    if out is not sys.stdout:
+        out.close()
+    sys.stderr.write("Processed %d lattices (%d errors) in %.2f seconds\n"
+                     % (len(files), nerr, time.time() - t))
+    return nerr != 0
+
+if __name__ == '__main__':
+    sys.exit(main())
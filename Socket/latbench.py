@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2007 Carnegie Mellon University
+#
+# You may copy and modify this freely under the same terms as
+# Sphinx-III
+
+"""
+Benchmarks for the lattice search and posterior routines in L{lattice}.
+
+Times each step of the usual lattice pipeline (loading, filler bypass,
+pruning, best path search, posterior computation and minimum error
+alignment) over the bundled lattice corpus and over synthetic lattices
+of increasing size, for example::
+
+    latbench.py -o before.json
+    latbench.py -o after.json -c before.json
+
+Results are reported as lattices and edges per second for the corpus,
+as seconds per lattice and an empirical scaling exponent for the
+synthetic lattices, and as peak resident memory.  They can be saved as
+JSON and compared against a previous run.
+"""
+
+import sys
+import os
+import glob
+import math
+import time
+import random
+import tempfile
+import resource
+import platform
+import optparse
+import json
+
+import lattice
+import latgen
+
+# Pipeline steps, in the order they are run on each lattice
+OPS = ('load', 'bypass_fillers', 'remove_unreachable', 'bestpath',
+       'bestpath_edges', 'posterior', 'array_posterior', 'minimum_error')
+
+class UniformLM(object):
+    """
+    Stand-in language model which gives every word the same score,
+    for benchmarking without sphinxbase.
+    """
+    lw = 1.0
+    wip = 1.0
+    def score(self, *syms):
+        return 0.0, len(syms)
+    def prob(self, *syms):
+        return 0.0, len(syms)
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def time_pipeline(load, ops, lm, repeat=1):
+    """
+    Run the pipeline on one lattice, returning the best time in
+    seconds taken by each step over C{repeat} runs.
+
+    @param load: Function returning a freshly loaded lattice
+    @type load: callable
+    @param ops: Steps to time (all steps are run)
+    @type ops: list of string
+    @param lm: Language model to use in search
+    @rtype: dict
+    """
+    best = {}
+    for r in range(repeat):
+        times = {}
+        t = time.time()
+        dag = load()
+        times['load'] = time.time() - t
+        t = time.time()
+        dag.bypass_fillers(lm)
+        times['bypass_fillers'] = time.time() - t
+        t = time.time()
+        dag.remove_unreachable()
+        times['remove_unreachable'] = time.time() - t
+        t = time.time()
+        dag.bestpath(lm)
+        times['bestpath'] = time.time() - t
+        hyp = [u.sym for u in dag.backtrace()
+               if not lattice.symtab.sentmark[u.wid]]
+        if 'bestpath_edges' in ops:
+            t = time.time()
+            dag.bestpath_edges(lm)
+            times['bestpath_edges'] = time.time() - t
+        if 'posterior' in ops:
+            t = time.time()
+            dag.posterior(lm)
+            times['posterior'] = time.time() - t
+        if 'array_posterior' in ops:
+            t = time.time()
+            dag.dag2array().posterior(lm)
+            times['array_posterior'] = time.time() - t
+        if 'minimum_error' in ops and hyp:
+            t = time.time()
+            dag.minimum_error(hyp)
+            times['minimum_error'] = time.time() - t
+        for op, secs in times.iteritems():
+            if op not in best or secs < best[op]:
+                best[op] = secs
+        best['n_nodes'] = dag.n_nodes()
+        best['n_edges'] = dag.n_edges()
+    return best
+
+def bench_corpus(files, ops, lm, repeat=1):
+    """
+    Benchmark the pipeline over a corpus of lattice files.
+
+    @return: Dictionary with total seconds, lattices per second and
+             edges per second for each step
+    @rtype: dict
+    """
+    totals = dict([(op, 0.0) for op in ops])
+    n_edges = 0
+    for latfile in files:
+        res = time_pipeline(lambda: lattice.Dag(latfile), ops, lm, repeat)
+        n_edges += res['n_edges']
+        for op in ops:
+            totals[op] += res.get(op, 0.0)
+    result = {'n_lattices': len(files), 'n_edges': n_edges, 'ops': {}}
+    for op in ops:
+        secs = totals[op]
+        if secs > 0:
+            result['ops'][op] = {'seconds': secs,
+                                 'lattices_per_sec': len(files) / secs,
+                                 'edges_per_sec': n_edges / secs}
+    return result
+
+def bench_synthetic(sizes, ops, lm, repeat=1):
+    """
+    Benchmark the pipeline over synthetic lattices of increasing size.
+
+    @param sizes: Numbers of frames for the synthetic lattices
+    @type sizes: list of int
+    @return: List of per-size results and the empirical scaling
+             exponent (slope of log time against log edges) for each step
+    @rtype: (list of dict, dict)
+    """
+    curve = []
+    vocab = latgen.load_vocabulary(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                'model', 'cleanmail.dic'),
+                                   1000, random.Random(0))
+    for n_frames in sizes:
+        dag = latgen.generate(n_frames, vocab, seed=n_frames)
+        # Round-trip through a file so that loading is timed too
+        fd, latfile = tempfile.mkstemp('.lat', 'latbench')
+        os.close(fd)
+        dag.dag2sphinx(latfile)
+        try:
+            res = time_pipeline(lambda: lattice.Dag(latfile), ops, lm, repeat)
+        finally:
+            os.unlink(latfile)
+        res['n_frames'] = n_frames
+        res['peak_rss_kb'] = peak_rss()
+        curve.append(res)
+        sys.stderr.write("%d frames, %d edges: %s\n"
+                         % (n_frames, res['n_edges'],
+                            " ".join(["%s=%.4f" % (op, res[op])
+                                      for op in ops if op in res])))
+    scaling = {}
+    for op in ops:
+        pts = [(math.log(r['n_edges']), math.log(r[op]))
+               for r in curve if r.get(op, 0) > 0]
+        if len(pts) < 2:
+            continue
+        mx = sum([x for x, y in pts]) / len(pts)
+        my = sum([y for x, y in pts]) / len(pts)
+        sxx = sum([(x - mx) ** 2 for x, y in pts])
+        if sxx > 0:
+            scaling[op] = sum([(x - mx) * (y - my) for x, y in pts]) / sxx
+    return curve, scaling
+
+def report(results, baseline=None, out=sys.stdout):
+    """
+    Print a summary of benchmark results, optionally compared
+    against a previous run.
+    """
+    corpus = results.get('corpus')
+    if corpus:
+        out.write("Corpus: %d lattices, %d edges\n"
+                  % (corpus['n_lattices'], corpus['n_edges']))
+        out.write("%-20s %12s %12s %12s" % ("step", "seconds", "lat/sec", "edges/sec"))
+        if baseline:
+            out.write(" %10s" % "speedup")
+        out.write("\n")
+        for op in OPS:
+            if op not in corpus['ops']:
+                continue
+            r = corpus['ops'][op]
+            out.write("%-20s %12.4f %12.1f %12.0f" % (op, r['seconds'],
+                                                      r['lattices_per_sec'],
+                                                      r['edges_per_sec']))
+            try:
+                old = baseline['corpus']['ops'][op]['seconds']
+                out.write(" %9.2fx" % (old / r['seconds']))
+            except (TypeError, KeyError):
+                pass
+            out.write("\n")
+    if results.get('scaling'):
+        out.write("\nScaling exponent (time ~ edges^k):\n")
+        for op in OPS:
+            if op in results['scaling']:
+                out.write("%-20s %6.2f" % (op, results['scaling'][op]))
+                try:
+                    out.write("  (was %.2f)" % baseline['scaling'][op])
+                except (TypeError, KeyError):
+                    pass
+                out.write("\n")
+    out.write("\nPeak RSS: %d kB\n" % results['peak_rss_kb'])
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [LATTICE|GLOB...]")
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="Save results as JSON to FILE")
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help="Compare against results saved in FILE")
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help="Runs per lattice, best time is kept (default: %default)")
+    parser.add_option('-s', '--sizes', default="50,100,200,400,800",
+                      help="Frame counts for synthetic lattices (default: %default)")
+    parser.add_option('--ops', default=",".join(OPS),
+                      help="Comma-separated steps to time (default: %default)")
+    parser.add_option('--lm', metavar='FILE',
+                      help="Language model (default: uniform scores)")
+    opts, args = parser.parse_args(argv)
+    ops = [op for op in opts.ops.split(',') if op]
+    for op in ops:
+        if op not in OPS:
+            parser.error("Unknown step %s (choose from %s)" % (op, ", ".join(OPS)))
+    if opts.lm:
+        import sphinxbase
+        lm = lattice.CachedLM(sphinxbase.NGramModel(opts.lm))
+    else:
+        lm = UniformLM()
+    if not args:
+        args = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'lattice', '*.lat')]
+    files = []
+    for arg in args:
+        files.extend(glob.glob(arg))
+    files.sort()
+    results = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(),
+               'repeat': opts.repeat}
+    if files:
+        results['corpus'] = bench_corpus(files, ops, lm, opts.repeat)
+    sizes = [int(s) for s in opts.sizes.split(',') if s]
+    if sizes:
+        results['synthetic'], results['scaling'] = \
+            bench_synthetic(sizes, ops, lm, opts.repeat)
+    results['peak_rss_kb'] = peak_rss()
+    baseline = None
+    if opts.compare:
+        baseline = json.load(open(opts.compare))
+    report(results, baseline)
+    if opts.output:
+        fh = open(opts.output, 'w')
+        json.dump(results, fh, indent=1, sort_keys=True)
+        fh.close()
+
+if __name__ == '__main__':
+    main()
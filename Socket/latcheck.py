@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2007 Carnegie Mellon University
+#
+# You may copy and modify this freely under the same terms as
+# Sphinx-III
+
+"""
+Regression checks for the lattice search and posterior routines in
+L{lattice}.
+
+Runs each routine on small lattices from the bundled corpus and
+compares its results with those found by enumerating every path
+through the lattice, for example::
+
+    latcheck.py
+    latcheck.py -m 200 lattice/000000012.lat
+
+Lattices with more than C{--max-paths} paths are skipped.  The
+language model is a stand-in which gives each word tuple a different
+but repeatable score, so that results do not depend on sphinxbase.
+The exit status is non-zero if any check fails.
+"""
+
+import sys
+import os
+import glob
+import math
+import zlib
+import optparse
+import itertools
+
+import lattice
+from lattice import symtab
+
+class HashLM(object):
+    """
+    Stand-in language model which gives each word tuple a repeatable
+    pseudo-random score, for checking without sphinxbase.
+    """
+    lw = 9.5
+    wip = 0.7
+    def prob(self, *syms):
+        return -(zlib.crc32('|'.join(syms)) % 1000) / 100.0 - 0.1, len(syms)
+    def score(self, *syms):
+        return self.prob(*syms)[0] * 3, len(syms)
+
+def logsum(values):
+    """
+    Return the log of the sum of the exponents of C{values}.
+    """
+    values = list(values)
+    if not values:
+        return lattice.LOGZERO
+    top = max(values)
+    return top + math.log(sum([math.exp(v - top) for v in values]))
+
+def count_paths(dag, fillers=True):
+    """
+    Count the paths from the start to the end of a lattice.
+
+    @param fillers: Count paths through filler words
+    @type fillers: boolean
+    @rtype: int
+    """
+    count = {}
+    for u in dag.topo_nodes():
+        if u == dag.start:
+            count[u] = 1
+        else:
+            count[u] = sum([count.get(x.src, 0) for x in u.entries
+                            if fillers or x.src == dag.start
+                            or not symtab.filler[x.src.wid]])
+    return count.get(dag.end, 0)
+
+def all_paths(dag, fillers=True):
+    """
+    Enumerate the paths from the start to the end of a lattice.
+
+    @param fillers: Include paths through filler words
+    @type fillers: boolean
+    @return: Links on each path
+    @rtype: list of list of Dag.Link
+    """
+    paths = []
+    def extend(u, links):
+        if u == dag.end:
+            paths.append(links)
+            return
+        if u != dag.start and symtab.filler[u.wid] and not fillers:
+            return
+        for x in u.exits:
+            extend(x.dest, links + [x])
+    extend(dag.start, [])
+    return paths
+
+def path_words(links):
+    """
+    Return the base words of the nodes on a path.
+    """
+    return ([symtab.basesym[links[0].src.wid]]
+            + [symtab.basesym[x.dest.wid] for x in links])
+
+def edit_distance(ref, hyp):
+    """
+    Return the Levenshtein distance between two word sequences.
+    """
+    prev = range(len(hyp) + 1)
+    for i, r in enumerate(ref):
+        row = [i + 1]
+        for j, h in enumerate(hyp):
+            row.append(min(prev[j] + (r != h), prev[j + 1] + 1, row[j] + 1))
+        prev = row
+    return prev[-1]
+
+def check_minimum_error(dag, lm, paths):
+    """
+    Check L{lattice.Dag.minimum_error} against the edit distance of
+    every path (without fillers) from three references: the best path
+    reversed with an extra word, an empty one, and one with only a
+    filler word.
+    """
+    errors = []
+    dag.bestpath(lm)
+    best = [u.sym for u in dag.backtrace()][1:-1]
+    for ref in (best[::-1] + ['FOO'], [], ['<sil>']):
+        base = [symtab.basesym[symtab.intern(w)] for w in ref
+                if not lattice.is_filler(w)]
+        expected = min([edit_distance(base, path_words(p)) for p in paths])
+        count, bt = dag.minimum_error(ref)
+        if count != expected:
+            errors.append("minimum_error(%r) = %d, expected %d"
+                          % (ref, count, expected))
+        aligned = [r for r, h in bt if r != 'INS']
+        if [symtab.basesym[symtab.intern(w)] for w in aligned] != base:
+            errors.append("minimum_error(%r) aligned %r" % (ref, aligned))
+        nerr = len([r for r, h in bt
+                    if r in ('INS', 'DEL') or h in ('INS', 'DEL')
+                    or symtab.basesym[symtab.intern(r)] != h])
+        if nerr != count:
+            errors.append("minimum_error(%r) alignment has %d errors, not %d"
+                          % (ref, nerr, count))
+    return errors
+
+def check_bypass_fillers(dag, lm):
+    """
+    Check L{lattice.Dag.bypass_fillers} against the best score of
+    every chain of filler words between each pair of other words.
+    """
+    filler = symtab.filler
+    # Default silence and filler probabilities are both 0.1
+    fillpen = math.log(0.1) * lm.lw + math.log(lm.wip)
+    def bypassed(u):
+        return filler[u.wid] and u != dag.end
+    expected = {}
+    def extend(u, v, score):
+        for x in v.exits:
+            if bypassed(x.dest):
+                extend(u, x.dest, score + x.ascr + fillpen)
+            elif ((u, x.dest) not in expected
+                  or score + x.ascr > expected[u, x.dest]):
+                expected[u, x.dest] = score + x.ascr
+    words = [u for u in dag.nodes if u == dag.start or not bypassed(u)]
+    for u in words:
+        extend(u, u, 0)
+    dag.bypass_fillers(lm)
+    errors = []
+    found = {}
+    for u in words:
+        for x in u.exits:
+            if bypassed(x.dest):
+                continue
+            if (u, x.dest) not in found or x.ascr > found[u, x.dest]:
+                found[u, x.dest] = x.ascr
+    for (u, v), ascr in expected.iteritems():
+        if (u, v) not in found:
+            errors.append("bypass_fillers missed %s(%d) -> %s(%d)"
+                          % (u.sym, u.entry, v.sym, v.entry))
+        elif abs(found[u, v] - ascr) > 1e-8:
+            errors.append("bypass_fillers %s(%d) -> %s(%d) = %f, expected %f"
+                          % (u.sym, u.entry, v.sym, v.entry, found[u, v], ascr))
+    for (u, v) in found:
+        if (u, v) not in expected:
+            errors.append("bypass_fillers added %s(%d) -> %s(%d)"
+                          % (u.sym, u.entry, v.sym, v.entry))
+    return errors
+
+def path_posteriors(dag, paths, score):
+    """
+    Compute the posterior log-probability of each link by summing
+    over paths.
+
+    @param score: Function giving the log-probability of a path
+    @type score: callable
+    @return: Posterior log-probability of each link
+    @rtype: dict of Dag.Link -> float
+    """
+    scores = [score(p) for p in paths]
+    norm = logsum(scores)
+    through = {}
+    for p, pscore in zip(paths, scores):
+        for x in p:
+            through.setdefault(x, []).append(pscore)
+    post = {}
+    for u in dag.nodes:
+        for x in u.exits:
+            post[x] = logsum(through.get(x, [])) - norm
+    return post
+
+def check_posterior(dag, lm, paths, tol, lw=0.5, aw=0.1):
+    """
+    Check L{lattice.Dag.posterior} and L{lattice.ArrayDag.posterior}
+    against link posteriors summed over every path, with bigram
+    probabilities for each word after the first.
+    """
+    def score(p):
+        words = path_words(p)
+        return (sum([x.ascr * aw for x in p])
+                + sum([lm.prob(w, v)[0] * lw
+                       for v, w in zip(words[:-2], words[1:-1])]))
+    expected = path_posteriors(dag, paths, score)
+    errors = []
+    dag.posterior(lm, lw, aw)
+    for x, post in expected.iteritems():
+        if post > lattice.LOGZERO and abs(x.post - post) > tol:
+            errors.append("posterior %s(%d) -> %s(%d) = %f, expected %f"
+                          % (x.src.sym, x.src.entry, x.dest.sym, x.dest.entry,
+                             x.post, post))
+    # Edges in an ArrayDag are identified by their ends and score
+    # (nodes are sorted stably by entry frame)
+    order = sorted(range(len(dag.nodes)), key=lambda i: dag.nodes[i].entry)
+    rank = {}
+    for r, i in enumerate(order):
+        rank[dag.nodes[i]] = r
+    byends = {}
+    for x, post in expected.iteritems():
+        byends[rank[x.src], rank[x.dest], x.ascr] = post
+    adag = dag.dag2array()
+    alpha, beta, apost = adag.posterior(lm, lw, aw)
+    for e in range(adag.n_edges()):
+        post = byends[adag.edge_src[e], adag.edge_dest[e], adag.edge_ascr[e]]
+        if post > lattice.LOGZERO and abs(apost[e] - post) > tol:
+            errors.append("array posterior of edge %d = %f, expected %f"
+                          % (e, apost[e], post))
+    return errors
+
+def check_posterior_tg(dag, lm, paths, tol, lw=0.5, aw=0.1):
+    """
+    Check L{lattice.Dag.posterior_tg} against link posteriors summed
+    over every path, with trigram probabilities for each word after
+    the first (bigram for the second).
+    """
+    def score(p):
+        words = path_words(p)
+        total = sum([x.ascr * aw for x in p])
+        for i in range(1, len(words) - 1):
+            hist = words[max(0, i - 2):i]
+            total += lm.prob(words[i], *hist[::-1])[0] * lw
+        return total
+    expected = path_posteriors(dag, paths, score)
+    errors = []
+    dag.posterior_tg(lm, lw, aw)
+    for x, post in expected.iteritems():
+        if post > lattice.LOGZERO and abs(x.post - post) > tol:
+            errors.append("posterior_tg %s(%d) -> %s(%d) = %f, expected %f"
+                          % (x.src.sym, x.src.entry, x.dest.sym, x.dest.entry,
+                             x.post, post))
+    return errors
+
+def check_nbest(dag, lm, paths, tol, n=20):
+    """
+    Check L{lattice.Dag.nbest} against the scores of every path
+    (without fillers), with and without duplicate word sequences.
+    """
+    def score(p):
+        total = 0
+        prev = None
+        for x in p:
+            syms = [symtab.basesym[x.dest.wid], symtab.basesym[x.src.wid]]
+            if prev != None:
+                syms.append(symtab.basesym[prev.wid])
+            total += x.ascr + lm.score(*syms)[0]
+            prev = x.src
+        return total
+    def words(nodes):
+        return tuple([symtab.basesym[u.wid] for u in nodes
+                      if not (symtab.filler[u.wid] or symtab.sentmark[u.wid])])
+    scored = [(score(p), p) for p in paths]
+    errors = []
+    for unique in (False, True):
+        if unique:
+            best = {}
+            for pscore, p in scored:
+                w = words([x.dest for x in p])
+                if w not in best or pscore > best[w]:
+                    best[w] = pscore
+            expected = best.values()
+        else:
+            best = None
+            expected = [pscore for pscore, p in scored]
+        expected.sort(reverse=True)
+        expected = expected[:n]
+        found = list(itertools.islice(dag.nbest(lm, unique=unique), n))
+        if len(found) != len(expected):
+            errors.append("nbest(unique=%s) gave %d paths, expected %d"
+                          % (unique, len(found), len(expected)))
+            continue
+        for i, ((fscore, nodes), escore) in enumerate(zip(found, expected)):
+            if abs(fscore - escore) > tol:
+                errors.append("nbest(unique=%s) path %d score = %f, expected %f"
+                              % (unique, i, fscore, escore))
+            # The path must be the best one for its words
+            elif best != None and abs(best[words(nodes)] - fscore) > tol:
+                errors.append("nbest(unique=%s) path %d is not the best for %r"
+                              % (unique, i, words(nodes)))
+    return errors
+
+# Checks which can be run, in order (see run_check)
+CHECKS = ['bypass_fillers', 'posterior', 'posterior_tg', 'nbest',
+          'minimum_error']
+
+def run_check(name, dag, lm, tol, max_paths):
+    """
+    Run one check on a lattice, preparing it as the check requires.
+
+    @return: Error messages, or None if the lattice has too many paths
+    @rtype: list of string
+    """
+    if name == 'bypass_fillers':
+        if count_paths(dag) > max_paths:
+            return None
+        return check_bypass_fillers(dag, lm)
+    dag.bypass_fillers(lm)
+    dag.remove_unreachable()
+    if name in ('posterior', 'posterior_tg'):
+        if count_paths(dag) > max_paths:
+            return None
+        if name == 'posterior':
+            return check_posterior(dag, lm, all_paths(dag), tol)
+        else:
+            return check_posterior_tg(dag, lm, all_paths(dag), tol)
+    if count_paths(dag, False) > max_paths:
+        return None
+    if name == 'nbest':
+        return check_nbest(dag, lm, all_paths(dag, False), tol)
+    elif name == 'minimum_error':
+        return check_minimum_error(dag, lm, all_paths(dag, False))
+    raise ValueError("Unknown check %s" % name)
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [LATTICE|GLOB...]")
+    parser.add_option('-m', '--max-paths', type='int', default=1000,
+                      help="Skip lattices with more paths (default: %default)")
+    parser.add_option('-t', '--tolerance', type='float', default=1e-8,
+                      help="Largest difference allowed in scores (default: %default)")
+    parser.add_option('-c', '--checks', default=",".join(CHECKS),
+                      help="Comma-separated checks to run (default: %default)")
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help="Print every error, not just the first per lattice")
+    opts, args = parser.parse_args(argv)
+    checks = [c for c in opts.checks.split(',') if c]
+    for c in checks:
+        if c not in CHECKS:
+            parser.error("Unknown check %s (choose from %s)" % (c, ", ".join(CHECKS)))
+    if not args:
+        args = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'lattice', '*.lat')]
+    files = []
+    for arg in args:
+        files.extend(glob.glob(arg))
+    files.sort()
+    lm = HashLM()
+    nfail = 0
+    for name in checks:
+        nrun = nbad = 0
+        for latfile in files:
+            errors = run_check(name, lattice.Dag(latfile), lm,
+                               opts.tolerance, opts.max_paths)
+            if errors == None:
+                continue
+            nrun += 1
+            if errors:
+                nbad += 1
+                if not opts.verbose:
+                    errors = errors[:1]
+                for err in errors:
+                    sys.stderr.write("%s: %s\n" % (latfile, err))
+        print "%-20s %4d lattices, %4d failed" % (name, nrun, nbad)
+        nfail += nbad
+    return nfail != 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2007 Carnegie Mellon University
+#
+# You may copy and modify this freely under the same terms as
+# Sphinx-III
+
+"""
+Synthetic word lattice generator.
+
+Generates random but well-formed word lattices, with controllable
+length, node density, fan-out, proportion of filler words and
+vocabulary, for benchmarking and load testing the routines in
+L{lattice}.  For example, to write ten lattices for 30-second noisy
+utterances::
+
+    latgen.py -n 10 -f 3000 -d 0.5 -F 6 --fillers 0.3 -o synth/
+
+Every node is reachable from C{<s>} and can reach C{</s>}, and every
+edge moves forward in time, as in lattices produced by the decoder.
+"""
+
+import sys
+import os
+import bisect
+import random
+import optparse
+
+import lattice
+
+# Filler words typical of noisy classroom audio
+FILLERS = ('<sil>', '++NOISE++', '++BREATH++', '++UH++', '++UM++', '++TONE++')
+
+def load_vocabulary(dictfile, size=None, rng=random):
+    """
+    Read words from a pronunciation dictionary, optionally choosing a
+    random subset.
+
+    @param dictfile: Dictionary file (one word and pronunciation per line)
+    @type dictfile: string
+    @param size: Number of words to choose (default is all of them)
+    @type size: int
+    @param rng: Random number generator
+    @type rng: random.Random
+    @return: Base words (without alternate pronunciation markers)
+    @rtype: list of string
+    """
+    words = {}
+    for spam in open(dictfile):
+        fields = spam.split()
+        if fields and not lattice.is_filler(fields[0]):
+            words[lattice.baseword(fields[0])] = 1
+    words = words.keys()
+    words.sort()
+    if size != None and size < len(words):
+        words = rng.sample(words, size)
+    return words
+
+def generate(n_frames, vocab, density=0.3, fanout=4, filler_ratio=0.1,
+             mindur=5, maxdur=50, frate=100, seed=None):
+    """
+    Generate a random word lattice.
+
+    @param n_frames: Number of frames in the utterance
+    @type n_frames: int
+    @param vocab: Words to draw from
+    @type vocab: list of string
+    @param density: Average number of words starting in each frame
+    @type density: float
+    @param fanout: Average number of exits from each node
+    @type fanout: float
+    @param filler_ratio: Proportion of nodes which are filler words
+    @type filler_ratio: float
+    @param mindur: Minimum word duration in frames
+    @type mindur: int
+    @param maxdur: Maximum word duration in frames
+    @type maxdur: int
+    @param frate: Number of frames per second
+    @type frate: int
+    @param seed: Seed for random number generator
+    @type seed: int
+    @rtype: lattice.Dag
+    """
+    rng = random.Random(seed)
+    dag = lattice.Dag(frate=frate)
+    dag.header = {'-logbase': '1.000100e+00'}
+    dag.getcwd = os.getcwd()
+    dag.n_frames = n_frames
+    dag.start = dag.Node('<s>', 0)
+    dag.end = dag.Node('</s>', n_frames)
+    # Word start times: a Poisson process with the given density
+    dag.nodes = [dag.start]
+    frame = mindur
+    while density > 0:
+        frame += int(rng.expovariate(density))
+        if frame > n_frames - mindur:
+            break
+        if rng.random() < filler_ratio:
+            sym = rng.choice(FILLERS)
+        else:
+            sym = rng.choice(vocab)
+        dag.nodes.append(dag.Node(sym, frame))
+    dag.nodes.append(dag.end)
+    for i, u in enumerate(dag.nodes):
+        u.id = i
+    entries = [u.entry for u in dag.nodes]
+    # Per-word acoustic "quality", so that some words are consistently
+    # better than others
+    quality = {}
+    def link(u, v):
+        if u.sym not in quality:
+            quality[u.sym] = rng.uniform(8, 12)
+        dur = v.entry - u.entry
+        ascr = -dur * quality[u.sym] * rng.uniform(0.9, 1.1)
+        x = dag.Link(u, v, ascr)
+        u.exits.append(x)
+        v.entries.append(x)
+    # Link each node to a random selection of successors
+    last = len(dag.nodes) - 1
+    for i, u in enumerate(dag.nodes[:-1]):
+        lo = bisect.bisect_left(entries, u.entry + mindur, i + 1, last)
+        hi = bisect.bisect_right(entries, u.entry + maxdur, lo, last)
+        n = min(hi - lo, max(1, int(rng.expovariate(1.0 / fanout) + 0.5)))
+        for j in rng.sample(xrange(lo, hi), n):
+            link(u, dag.nodes[j])
+        if n_frames - u.entry <= maxdur:
+            link(u, dag.end)
+    # Connect nodes with no predecessors back to the start of the
+    # lattice, and nodes with no successors forward to the end.
+    for i in range(1, last):
+        v = dag.nodes[i]
+        if not v.entries:
+            lo = bisect.bisect_left(entries, v.entry - maxdur, 0, i)
+            hi = bisect.bisect_right(entries, v.entry - mindur, lo, i)
+            if lo < hi:
+                link(dag.nodes[rng.randrange(lo, hi)], v)
+            else:
+                link(dag.start, v)
+    for i in range(last - 1, 0, -1):
+        u = dag.nodes[i]
+        if not u.exits:
+            lo = bisect.bisect_left(entries, u.entry + mindur, i + 1, last)
+            hi = bisect.bisect_right(entries, u.entry + maxdur, lo, last)
+            if lo < hi:
+                link(u, dag.nodes[rng.randrange(lo, hi)])
+            else:
+                link(u, dag.end)
+    dag.sort_nodes_forward()
+    return dag
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-o', '--outdir', default='.',
+                      help="Directory to write lattices to (default: %default)")
+    parser.add_option('-n', '--count', type='int', default=1,
+                      help="Number of lattices to generate (default: %default)")
+    parser.add_option('-f', '--frames', type='int', default=1000,
+                      help="Number of frames per lattice (default: %default)")
+    parser.add_option('-d', '--density', type='float', default=0.3,
+                      help="Average words starting per frame (default: %default)")
+    parser.add_option('-F', '--fanout', type='float', default=4,
+                      help="Average exits per node (default: %default)")
+    parser.add_option('--fillers', type='float', default=0.1,
+                      help="Proportion of filler nodes (default: %default)")
+    parser.add_option('--mindur', type='int', default=5,
+                      help="Minimum word duration in frames (default: %default)")
+    parser.add_option('--maxdur', type='int', default=50,
+                      help="Maximum word duration in frames (default: %default)")
+    parser.add_option('--dict', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                     'model', 'cleanmail.dic'),
+                      help="Dictionary to draw words from (default: %default)")
+    parser.add_option('-V', '--vocab', type='int', default=1000,
+                      help="Number of words to draw from the dictionary (default: %default)")
+    parser.add_option('--format', default='sphinx', choices=('sphinx', 'htk'),
+                      help="Output format, sphinx or htk (default: %default)")
+    parser.add_option('-z', '--gzip', action='store_true',
+                      help="Compress output files")
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help="Random seed (default: %default)")
+    opts, args = parser.parse_args(argv)
+    rng = random.Random(opts.seed)
+    vocab = load_vocabulary(opts.dict, opts.vocab, rng)
+    if not os.path.isdir(opts.outdir):
+        os.makedirs(opts.outdir)
+    for i in range(opts.count):
+        dag = generate(opts.frames, vocab, opts.density, opts.fanout,
+                       opts.fillers, opts.mindur, opts.maxdur,
+                       seed=rng.randrange(1 << 30))
+        if opts.format == 'htk':
+            latfile = os.path.join(opts.outdir, "synth%06d.slf" % i)
+        else:
+            latfile = os.path.join(opts.outdir, "synth%06d.lat" % i)
+        if opts.gzip:
+            latfile += '.gz'
+        if opts.format == 'htk':
+            dag.dag2htk(latfile)
+        else:
+            dag.dag2sphinx(latfile, 1.0001)
+        sys.stderr.write("%s: %d frames, %d nodes, %d edges\n"
+                         % (latfile, dag.n_frames, dag.n_nodes(), dag.n_edges()))
+
+if __name__ == '__main__':
+    main()
@@ -13,10 +13,15 @@ searching them, and calculating word posterior probabilities.
 __author__ = "David Huggins-Daines <dhuggins@cs.cmu.edu>"
 __version__ = "$Revision: 7544 $"
 
+import bisect
+import collections
 import gzip
+import heapq
 import re
 import math
+import mmap
 import os
+import struct
 try:
     import numpy
 except:
@@ -24,6 +29,11 @@ except:
 
 LOGZERO = -100000
 
+# Binary lattice format (see ArrayDag.array2binary)
+BINARY_MAGIC = 'LATB'
+BINARY_VERSION = 1
+binary_header = struct.Struct('<4s9I')
+
 def logadd(x,y):
     """
     For M{x=log(a)} and M{y=log(b)}, return M{z=log(a+b)}.
@@ -64,30 +74,400 @@ def baseword(sym):
     else:
         return sym
 
+class SymbolTable(object):
+    """
+    Table of interned word strings.
+
+    Each distinct word string is assigned an integer ID the first time
+    it is seen, along with precomputed flags, so that search routines
+    can compare integers rather than re-parsing strings.
+
+    @ivar syms: Word string for each ID
+    @type syms: list of string
+    @ivar ids: ID for each word string
+    @type ids: dict
+    @ivar filler: Whether each ID is a filler word (see L{is_filler})
+    @type filler: list of bool
+    @ivar sentmark: Whether each ID is a sentence marker (<s> or </s>)
+    @type sentmark: list of bool
+    @ivar base: ID of the base word (see L{baseword}) for each ID
+    @type base: list of int
+    @ivar basesym: Base word string for each ID
+    @type basesym: list of string
+    @ivar sil: ID of the silence word
+    @type sil: int
+    """
+    def __init__(self):
+        self.syms = []
+        self.ids = {}
+        self.filler = []
+        self.sentmark = []
+        self.base = []
+        self.basesym = []
+        self._arrays = None
+        self.sil = self.intern('<sil>')
+
+    def __len__(self):
+        return len(self.syms)
+
+    def __getitem__(self, wid):
+        return self.syms[wid]
+
+    def intern(self, sym):
+        """
+        Return the ID for C{sym}, adding it to the table if necessary.
+
+        @param sym: Word string
+        @type sym: string
+        @rtype: int
+        """
+        try:
+            return self.ids[sym]
+        except KeyError:
+            pass
+        wid = len(self.syms)
+        self.ids[sym] = wid
+        self.syms.append(sym)
+        self.filler.append(is_filler(sym))
+        self.sentmark.append(sym == '<s>' or sym == '</s>')
+        self.base.append(wid)
+        self.basesym.append(sym)
+        base = baseword(sym)
+        if base != sym:
+            self.base[wid] = self.intern(base)
+            self.basesym[wid] = self.syms[self.base[wid]]
+        return wid
+
+    def arrays(self):
+        """
+        Return the filler, sentence marker and base word tables as
+        NumPy arrays, for indexing with arrays of IDs.
+
+        @rtype: (numpy.ndarray of bool, numpy.ndarray of bool,
+                 numpy.ndarray of int32)
+        """
+        if self._arrays == None or len(self._arrays[0]) != len(self.syms):
+            self._arrays = (numpy.array(self.filler, bool),
+                            numpy.array(self.sentmark, bool),
+                            numpy.array(self.base, 'i'))
+        return self._arrays
+
+# Symbol table shared by all lattices
+symtab = SymbolTable()
 
 def node_lmscore(v, u, lm, silpen=0, fillpen=0):
     if lm == None:
         return 0
-    elif v.sym == '<sil>':
+    elif v.wid == symtab.sil:
         return silpen, 1
-    elif is_filler(v.sym):
+    elif symtab.filler[v.wid]:
         return fillpen, 1
     else:
-        syms = [baseword(v.sym)]
+        syms = [symtab.basesym[v.wid]]
         # Trace back to find previous non-filler word.
         hist = u
-        while hist and is_filler(hist.sym):
+        while hist and symtab.filler[hist.wid]:
             hist = hist.prev
         if hist:
-            syms.append(baseword(hist.sym))
+            syms.append(symtab.basesym[hist.wid])
         # And the one before that too.
         hist = hist.prev
-        while hist and is_filler(hist.sym):
+        while hist and symtab.filler[hist.wid]:
             hist = hist.prev
         if hist:
-            syms.append(baseword(hist.sym))
+            syms.append(symtab.basesym[hist.wid])
         return lm.score(*syms)
 
+class CachedLM(object):
+    """
+    Memoizing wrapper around a language model.
+
+    Lattice search looks up the same few word tuples over and over.
+    This wraps any object with C{score} and C{prob} methods (such as
+    C{sphinxbase.NGramModel}) and remembers their results, keyed on
+    the method and the (word, history...) tuple.  The least recently
+    used entries are evicted once C{maxsize} results are cached.  All
+    other attributes (such as C{lw} and C{wip}) are passed through to
+    the wrapped model.
+
+    @ivar lm: Wrapped language model
+    @type lm: sphinxbase.NGramModel (or equivalent)
+    @ivar maxsize: Maximum number of cached results
+    @type maxsize: int
+    @ivar hits: Number of lookups answered from the cache
+    @type hits: int
+    @ivar misses: Number of lookups passed to the wrapped model
+    @type misses: int
+    """
+    def __init__(self, lm, maxsize=65536):
+        """
+        Wrap a language model.
+
+        @param lm: Language model to wrap
+        @type lm: sphinxbase.NGramModel (or equivalent)
+        @param maxsize: Maximum number of cached results
+        @type maxsize: int
+        """
+        self.lm = lm
+        self.maxsize = maxsize
+        self.clear()
+
+    def __getattr__(self, name):
+        return getattr(self.lm, name)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __nonzero__(self):
+        # Always true, even when empty (code tests "if lm:")
+        return True
+
+    def clear(self):
+        """
+        Empty the cache and reset the hit and miss counters.
+        """
+        self.hits = self.misses = 0
+        self.cache = {}
+        # Circular doubly linked list of [prev, next, key, value],
+        # ordered from least to most recently used
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def lookup(self, method, syms):
+        """
+        Return the result of calling C{method} on the wrapped model
+        with arguments C{syms}, from the cache if possible.
+
+        @param method: Name of method ('score' or 'prob')
+        @type method: string
+        @param syms: Word followed by its history
+        @type syms: tuple of string
+        """
+        key = (method,) + syms
+        link = self.cache.get(key)
+        root = self.root
+        if link is not None:
+            self.hits += 1
+            # Move it to the most recently used end of the list
+            prev, next = link[0], link[1]
+            prev[1] = next
+            next[0] = prev
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return link[3]
+        self.misses += 1
+        value = getattr(self.lm, method)(*syms)
+        if len(self.cache) >= self.maxsize:
+            # Evict the least recently used entry
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.cache[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self.cache[key] = link
+        return value
+
+    def score(self, *syms):
+        """
+        Return the (cached) language model score and backoff mode for
+        a word given its history.
+        """
+        return self.lookup('score', syms)
+
+    def prob(self, *syms):
+        """
+        Return the (cached) language model probability and backoff
+        mode for a word given its history.
+        """
+        return self.lookup('prob', syms)
+
+    def hit_rate(self):
+        """
+        Return the fraction of lookups answered from the cache.
+        @rtype: float
+        """
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+sphinx_headre = re.compile(r'# (-\S+) (\S+)')
+sphinx_sectre = re.compile(r'^(Frames|Nodes|Initial|Final|BestSegAscr|Edges|End)\b(.*)$',
+                           re.MULTILINE)
+sphinx_commentre = re.compile(r'^#.*$', re.MULTILINE)
+def read_sphinx(s3file):
+    """
+    Read a Sphinx-III format lattice file in bulk.
+
+    Rather than examining the file line by line, this reads it all at
+    once, locates the section headers, and splits the C{Nodes} and
+    C{Edges} sections as whole blocks.  Files ending in C{.gz} are
+    decompressed.
+
+    @param s3file: Sphinx-III format word lattice file (optionally gzipped)
+    @type s3file: string
+    @return: Dictionary with keys C{header} (dict of header arguments),
+             C{getcwd} (string or None), C{n_frames} (int), C{words}
+             and C{entry} (word and start frame indexed by node ID),
+             C{start} and C{end} (node IDs), and C{edge_src},
+             C{edge_dest} and C{edge_ascr} (lists, with acoustic scores
+             converted to natural log base).
+    @rtype: dict
+    """
+    if s3file.endswith('.gz'): # DUMB
+        fh = gzip.open(s3file)
+    else:
+        fh = open(s3file)
+    text = fh.read()
+    fh.close()
+    lat = {'header': {}, 'getcwd': None, 'n_frames': 0,
+           'words': [], 'entry': [], 'start': None, 'end': None,
+           'edge_src': [], 'edge_dest': [], 'edge_ascr': []}
+    sections = list(sphinx_sectre.finditer(text))
+    if not sections:
+        raise ValueError("%s is not a Sphinx-III lattice" % s3file)
+    # Parse header comments
+    logbase = math.log(1.0003)
+    for spam in text[:sections[0].start()].splitlines():
+        m = sphinx_headre.match(spam)
+        if m:
+            arg, val = m.groups()
+            lat['header'][arg] = val
+            if arg == '-logbase':
+                logbase = math.log(float(val))
+        if spam.startswith('# getcwd:'):
+            lat['getcwd'] = spam[len('# getcwd:'):].strip()
+    # Parse sections, each of which extends up to the next one
+    for i, m in enumerate(sections):
+        name, args = m.group(1), m.group(2).split()
+        if i + 1 < len(sections):
+            block = text[m.end():sections[i+1].start()]
+        else:
+            block = text[m.end():]
+        if '#' in block:
+            block = sphinx_commentre.sub('', block)
+        if name == 'Frames':
+            lat['n_frames'] = int(args[0])
+        elif name == 'Initial':
+            lat['start'] = int(args[0])
+        elif name == 'Final':
+            lat['end'] = int(args[0])
+        elif name == 'Nodes':
+            nnodes = int(args[0])
+            fields = block.split()
+            words = lat['words'] = [None] * nnodes
+            entry = lat['entry'] = [0] * nnodes
+            for nodeid, word, sf in zip(fields[0::5], fields[1::5],
+                                        fields[2::5]):
+                words[int(nodeid)] = word
+                entry[int(nodeid)] = int(sf)
+        elif name == 'Edges':
+            if 'numpy' in globals():
+                edges = numpy.fromstring(block, 'd', sep=' ').reshape(-1, 3)
+                lat['edge_src'] = edges[:,0].astype(int).tolist()
+                lat['edge_dest'] = edges[:,1].astype(int).tolist()
+                lat['edge_ascr'] = (edges[:,2] * logbase).tolist()
+            else:
+                fields = block.split()
+                lat['edge_src'] = map(int, fields[0::3])
+                lat['edge_dest'] = map(int, fields[1::3])
+                lat['edge_ascr'] = [float(ascr) * logbase
+                                    for ascr in fields[2::3]]
+    return lat
+
+class TimeIndex(object):
+    """
+    Index of lattice nodes and edges by time.
+
+    Finds the nodes starting in, and the edges active in, a range of
+    frames in logarithmic time plus the size of the output.  Edges are
+    sorted by the entry frame of their source node and kept in the
+    leaves of an implicit binary tree, each of whose internal nodes
+    holds the latest exit frame (entry frame of the destination node)
+    of any edge below it.  Searches only descend into subtrees
+    containing edges which end after the start of the range.
+
+    @ivar nodes: Indexed nodes, sorted by entry frame
+    @type nodes: list of Dag.Node
+    @ivar edges: Exits of the indexed nodes, sorted by entry frame
+    @type edges: list of Dag.Link
+    """
+    def __init__(self, nodes):
+        """
+        Build an index over the given nodes and all their exits.
+
+        @param nodes: Nodes to index
+        @type nodes: list of Dag.Node
+        """
+        self.nodes = list(nodes)
+        self.nodes.sort(lambda x,y: cmp(x.entry, y.entry))
+        self.node_entries = [u.entry for u in self.nodes]
+        self.edges = []
+        for u in self.nodes:
+            self.edges.extend(u.exits)
+        self.edge_entries = [x.src.entry for x in self.edges]
+        size = 1
+        while size < len(self.edges):
+            size *= 2
+        self.size = size
+        latest = [-1] * (2 * size)
+        for i, x in enumerate(self.edges):
+            latest[size + i] = x.dest.entry
+        for i in range(size - 1, 0, -1):
+            latest[i] = max(latest[2 * i], latest[2 * i + 1])
+        self.latest = latest
+
+    def node_range(self, start, end):
+        """
+        Return all nodes starting in frames C{start} to C{end - 1}.
+        """
+        lo = bisect.bisect_left(self.node_entries, start)
+        hi = bisect.bisect_left(self.node_entries, end, lo)
+        return self.nodes[lo:hi]
+
+    def edge_range(self, start, end):
+        """
+        Return all edges active in the time range C{start} to C{end},
+        i.e. those starting no later than C{end} and ending after
+        C{start}, in order of their start times.
+        """
+        size = self.size
+        latest = self.latest
+        edges = self.edges
+        # Find the subtrees covering all edges starting before the end
+        # of the range, from left to right
+        lo = size
+        hi = size + bisect.bisect_right(self.edge_entries, end)
+        left = []
+        right = []
+        while lo < hi:
+            if lo & 1:
+                left.append(lo)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                right.append(hi)
+            lo >>= 1
+            hi >>= 1
+        right.reverse()
+        # Then collect the edges in them which end after its start
+        result = []
+        for root in left + right:
+            agenda = [root]
+            while agenda:
+                i = agenda.pop()
+                if latest[i] <= start:
+                    continue
+                if i >= size:
+                    result.append(edges[i - size])
+                else:
+                    agenda.append(2 * i + 1)
+                    agenda.append(2 * i)
+        return result
+
 class Dag(object):
     """
     Directed acyclic graph representation of a phone/word lattice.
@@ -100,6 +480,8 @@ class Dag(object):
                    this node represent hypothesized instances of this
                    word starting at frame C{entry}.
         @type sym: string
+        @ivar wid: ID of C{sym} in the shared symbol table
+        @type wid: int
         @ivar id: Numeric ID used to index this in external arrays
         @type fan: int
         @ivar entry: Entry frame for this node.
@@ -115,9 +497,11 @@ class Dag(object):
                     calculation.
         @type prev: object
         """
-        __slots__ = 'sym', 'entry', 'exits', 'entries', 'score', 'prev', 'fan', 'id'
+        __slots__ = ('sym', 'wid', 'entry', 'exits', 'entries', 'score',
+                     'prev', 'fan', 'id')
         def __init__(self, sym, entry, id=-1):
-            self.sym = sym
+            self.wid = symtab.intern(sym)
+            self.sym = symtab.syms[self.wid]
             self.id = id
             self.fan = 0
             self.entry = entry
@@ -185,6 +569,7 @@ class Dag(object):
         @type htk_file: string
         """
         self.frate = frate
+        self.invalidate()
         if sphinx_file != None:
             self.sphinx2dag(sphinx_file)
         elif htk_file != None:
@@ -193,7 +578,10 @@ class Dag(object):
     fieldre = re.compile(r'(\S+)=(?:"((?:[^\\"]+|\\.)*)"|(\S+))')
     def htk2dag(self, htkfile):
         """Read an HTK-format lattice file to populate a DAG."""
-        fh = gzip.open(htkfile)
+        if htkfile.endswith('.gz'): # DUMB
+            fh = gzip.open(htkfile)
+        else:
+            fh = open(htkfile)
         self.header = {}
         self.n_frames = 0
         state='header'
@@ -214,7 +602,7 @@ class Dag(object):
             else:
                 # This is a node
                 if 'I' in fields:
-                    frame = int(float(fields['t']) * self.frate)
+                    frame = int(float(fields['t']) * self.frate + 0.5)
                     node = self.Node(fields['W'], frame, int(fields['I']))
                     self.nodes[int(fields['I'])] = node
                     if frame > self.n_frames:
@@ -243,63 +631,65 @@ class Dag(object):
                 x.dest = self.nodes[int(x.dest)]
                 x.dest.entries.append(x)
 
+    def invalidate(self):
+        """
+        Discard cached indexes of the DAG.  This is done by the methods
+        which add or remove nodes and links, but must be called
+        explicitly after modifying C{nodes}, C{exits} or C{entries}
+        directly.
+        """
+        self._timeindex = None
+        self._wordnodes = None
+        self._linkindex = None
+        self._nodeorder = None
+        self._edgeorder = None
+        self._redgeorder = None
+
+    def time_index(self, base=None):
+        """
+        Return an index of nodes and edges by time, building it if
+        necessary.
+
+        @param base: Only index nodes for this base word ID (see
+                     L{SymbolTable}), and their exits
+        @type base: int
+        @rtype: TimeIndex
+        """
+        if self._timeindex == None:
+            self._timeindex = {}
+        if base not in self._timeindex:
+            if base == None:
+                self._timeindex[base] = TimeIndex(self.nodes)
+            else:
+                if self._wordnodes == None:
+                    self._wordnodes = {}
+                    for u in self.nodes:
+                        self._wordnodes.setdefault(symtab.base[u.wid], []).append(u)
+                self._timeindex[base] = TimeIndex(self._wordnodes.get(base, []))
+        return self._timeindex[base]
+
     def sort_nodes_forward(self):
+        self.invalidate()
         # Sort nodes by starting point
         self.nodes.sort(lambda x,y: cmp(x.entry, y.entry))
         # Sort edges by ending point
         for n in self.nodes:
             n.exits.sort(lambda x,y: cmp(x.dest.entry, y.dest.entry))
 
-    headre = re.compile(r'# (-\S+) (\S+)')
+    headre = sphinx_headre
     def sphinx2dag(self, s3file):
         """Read a Sphinx-III format lattice file to populate a DAG."""
-        if s3file.endswith('.gz'): # DUMB
-            fh = gzip.open(s3file)
-        else:
-            fh = open(s3file)
-        self.header = {}
-        self.getcwd = None
-        state = 'header'
-        logbase = math.log(1.0003)
-        for spam in fh:
-            spam = spam.rstrip()
-            m = self.headre.match(spam)
-            if m:
-                arg, val = m.groups()
-                self.header[arg] = val
-                if arg == '-logbase':
-                    logbase = math.log(float(val))
-            if spam.startswith('# getcwd:'):
-                self.getcwd = spam[len('# getcwd:'):].strip()
-            if spam.startswith('#'):
-                continue
-            else:
-                fields = spam.split()
-                if fields[0] == 'Frames':
-                    self.n_frames = int(fields[1])
-                elif fields[0] == 'Nodes':
-                    state='nodes'
-                    nnodes = int(fields[1])
-                    self.nodes = [None] * nnodes
-                elif fields[0] == 'Initial':
-                    state = 'crud'
-                    self.start = self.nodes[int(fields[1])]
-                elif fields[0] == 'Final':
-                    self.end = self.nodes[int(fields[1])]
-                elif fields[0] == 'Edges':
-                    state='edges'
-                elif fields[0] == 'End':
-                    state='done'
-                else:
-                    if state == 'nodes':
-                        nodeid, word, sf, fef, lef = fields
-                        node = self.Node(word, int(sf), int(nodeid))
-                        self.nodes[int(nodeid)] = node
-                    elif state == 'edges':
-                        fromnode, tonode, ascr = fields
-                        ascr = float(ascr) * logbase
-                        self.nodes[int(fromnode)].exits.append(
-                            self.Link(fromnode, tonode, ascr))
+        lat = read_sphinx(s3file)
+        self.header = lat['header']
+        self.getcwd = lat['getcwd']
+        self.n_frames = lat['n_frames']
+        self.nodes = [self.Node(word, sf, nodeid) for nodeid, (word, sf)
+                      in enumerate(zip(lat['words'], lat['entry']))]
+        self.start = self.nodes[lat['start']]
+        self.end = self.nodes[lat['end']]
+        for fromnode, tonode, ascr in zip(lat['edge_src'], lat['edge_dest'],
+                                          lat['edge_ascr']):
+            self.nodes[fromnode].exits.append(self.Link(fromnode, tonode, ascr))
         if self.getcwd == None:
             self.getcwd = os.getcwd()
         # Snap links to nodes to point to the objects themselves
@@ -347,6 +737,41 @@ class Dag(object):
         fh.write("End\n")
         fh.close()
 
+    def dag2htk(self, outfile):
+        """
+        Write this DAG in HTK SLF format, with the start node first
+        and the end node last (as assumed by L{htk2dag}).
+
+        @param outfile: File to write (gzipped if it ends in C{.gz})
+        @type outfile: string
+        """
+        if outfile.endswith('.gz'): # DUMB
+            fh = gzip.open(outfile, "w")
+        else:
+            fh = open(outfile, "w")
+        fh.write("VERSION=1.0\n")
+        for arg, val in self.header.iteritems():
+            if arg not in ('VERSION', 'N', 'L'):
+                fh.write("%s=%s\n" % (arg, val))
+        nodes = ([self.start]
+                 + [u for u in self.nodes if u != self.start and u != self.end]
+                 + [self.end])
+        fh.write("N=%d L=%d\n" % (len(nodes), self.n_edges()))
+        idmap = {}
+        for i, u in enumerate(nodes):
+            idmap[u] = i
+            fh.write("I=%d t=%.3f W=%s\n" % (i, float(u.entry) / self.frate, u.sym))
+        j = 0
+        for u in nodes:
+            for x in u.exits:
+                lscr = x.lscr
+                if lscr == LOGZERO:
+                    lscr = 0
+                fh.write("J=%d S=%d E=%d a=%f n=%f\n"
+                         % (j, idmap[u], idmap[x.dest], x.ascr, lscr))
+                j += 1
+        fh.close()
+
     def dag2dot(self, outfile):
         fh = open(outfile, "w")
         fh.write("digraph lattice {\n\trankdir=LR;\n\t")
@@ -363,6 +788,25 @@ class Dag(object):
         fh.write("}\n")
         fh.close()
 
+    def dag2array(self):
+        """
+        Convert this DAG to a compact array-backed lattice.
+
+        @return: Lattice with the same nodes and edges as this one.
+        @rtype: ArrayDag
+        """
+        return ArrayDag(dag=self)
+
+    def dag2binary(self, outfile):
+        """
+        Write this DAG in binary lattice format, which can be loaded
+        with C{ArrayDag(binary_file=outfile)}.
+
+        @param outfile: File to write
+        @type outfile: string
+        """
+        self.dag2array().array2binary(outfile)
+
     def n_nodes(self):
         """
         Return the number of nodes in the DAG
@@ -402,28 +846,30 @@ class Dag(object):
             start = self.start
         if end == None:
             end = self.end
+        filler = symtab.filler
+        basesym = symtab.basesym
         # Initialize path scores for all links exiting start
         for e in start.exits:
-            if is_filler(e.dest.sym) and e.dest != end:
+            if filler[e.dest.wid] and e.dest != end:
                 continue
-            e.lscr, e.lback = lm.score(baseword(e.dest.sym),
-                                       baseword(e.src.sym))
+            e.lscr, e.lback = lm.score(basesym[e.dest.wid],
+                                       basesym[e.src.wid])
             e.pscr = e.ascr + e.lscr
         # Track the best link entering the end node
         bestend = None
         bestescr = LOGZERO
-        for e in self.traverse_edges_breadth():
+        for e in self.topo_edges():
             # Skip filler nodes in traversal
-            if is_filler(e.dest.sym) and e.dest != end:
+            if filler[e.dest.wid] and e.dest != end:
                 continue
             # Update scores for all paths exiting e.dest
             for f in e.dest.exits:
                 # Skip filler nodes in update
-                if is_filler(f.dest.sym) and f.dest != end:
+                if filler[f.dest.wid] and f.dest != end:
                     continue
-                lscr, lback = lm.score(baseword(f.dest.sym),
-                                       baseword(e.dest.sym),
-                                       baseword(e.src.sym))
+                lscr, lback = lm.score(basesym[f.dest.wid],
+                                       basesym[e.dest.wid],
+                                       basesym[e.src.wid])
                 pscr = e.pscr + f.ascr + lscr
                 # Update its score
                 if pscr > f.pscr:
@@ -452,25 +898,33 @@ class Dag(object):
         backtrace.reverse()
         return backtrace
 
-    def bestpath(self, lm=None, start=None, end=None):
+    def bestpath(self, lm=None, start=None, end=None, method='viterbi'):
         """
-        Find best path through lattice using Dijkstra's algorithm.
+        Find best path through lattice.
+
+        With C{method='viterbi'} (the default), this visits each node
+        once in topological (time) order, which takes time linear in
+        the size of the lattice.  With C{method='dijkstra'}, it uses
+        Dijkstra's algorithm with a linear scan for the best node,
+        which takes time quadratic in the number of nodes.
 
         It is assumed that filler words have been bypassed before this
         function is called.
 
-        @param lm: Language model to use in search
+        @param lm: Language model to use in search (if None, use
+                   acoustic scores only)
         @type lm: sphinxbase.ngram_model (or equivalent)
         @param start: Node to start search from
         @type start: Dag.Node
         @param end: Node to end search at
         @type end: Dag.Node
+        @param method: Search algorithm, either 'viterbi' or 'dijkstra'
+        @type method: string
         @return: Final node in search (same as C{end})
         @rtype: Dag.Node
         """
         # Reset all path scores and backpointers
-        Q = self.nodes[:]
-        for u in Q:
+        for u in self.nodes:
             u.score = LOGZERO
             u.prev = None
         if start == None:
@@ -478,32 +932,54 @@ class Dag(object):
         if end == None:
             end = self.end
         start.score = 0
-        while Q:
-            bestscore = LOGZERO
-            bestidx = 0
-            for i,u in enumerate(Q):
-                if is_filler(u.sym) and u != end:
-                    continue
-                if u.score > bestscore:
-                    bestidx = i
-                    bestscore = u.score
-            u = Q[bestidx]
-            del Q[bestidx]
-            if u == end:
-                return u
+        filler = symtab.filler
+        basesym = symtab.basesym
+        def relax(u):
             for x in u.exits:
                 v = x.dest
                 # Recaculate the language model score based on the
                 # best history (FIXME: This is an approximation, since
                 # there might be a higher scoring trigram?)
-                syms = [baseword(v.sym), baseword(u.sym)]
-                if u.prev:
-                    syms.append(baseword(u.prev.sym))
-                x.lscr, x.lback = lm.score(*syms)
+                if lm != None:
+                    syms = [basesym[v.wid], basesym[u.wid]]
+                    if u.prev:
+                        syms.append(basesym[u.prev.wid])
+                    x.lscr, x.lback = lm.score(*syms)
+                else:
+                    x.lscr, x.lback = 0, 0
                 x.pscr = u.score + x.ascr + x.lscr
                 if x.pscr > v.score:
                     v.score = x.pscr
                     v.prev = u
+        if method == 'viterbi':
+            # In topological order all predecessors of a node have
+            # been relaxed by the time we reach it.
+            for u in self.topo_nodes():
+                if u == end:
+                    return u
+                if u.prev == None and u != start:
+                    continue # Not reachable from start
+                if filler[u.wid]:
+                    continue
+                relax(u)
+        elif method == 'dijkstra':
+            Q = self.nodes[:]
+            while Q:
+                bestscore = LOGZERO
+                bestidx = 0
+                for i,u in enumerate(Q):
+                    if filler[u.wid] and u != end:
+                        continue
+                    if u.score > bestscore:
+                        bestidx = i
+                        bestscore = u.score
+                u = Q[bestidx]
+                del Q[bestidx]
+                if u == end:
+                    return u
+                relax(u)
+        else:
+            raise ValueError("Unknown search method %s" % method)
 
     def backtrace(self, end=None):
         """
@@ -523,11 +999,144 @@ class Dag(object):
         backtrace.reverse()
         return backtrace
 
+    def nbest(self, lm=None, start=None, end=None, unique=True,
+              max_agenda=100000):
+        """
+        Generate the best paths through the lattice, in order of
+        decreasing score, using A* search.
+
+        Path scores are the sum of acoustic scores and trigram
+        language model scores, as in L{bestpath_edges}.  The heuristic
+        is the Viterbi score of the best path to the end from each
+        node, for each distinct word preceding it, found in a backward
+        pass over the lattice.  Since this is the exact score of the
+        best way to complete a path, paths are produced in exact order
+        and the search only expands partial paths which can lead to
+        the next one.
+
+        If the agenda of partial paths grows beyond C{2 * max_agenda}
+        entries, only the best C{max_agenda} are kept.  As each of
+        these can be completed, the first C{max_agenda} paths found
+        are still exact, though if C{unique} is set some of them may
+        be skipped as duplicates.
+
+        It is assumed that filler words have been bypassed before this
+        function is called.
+
+        @param lm: Language model to use in search (if None, use
+                   acoustic scores only)
+        @type lm: sphinxbase.ngram_model (or equivalent)
+        @param start: Node to start search from
+        @type start: Dag.Node
+        @param end: Node to end search at
+        @type end: Dag.Node
+        @param unique: Only produce the best path for each distinct
+                       sequence of words (ignoring fillers and
+                       sentence markers)
+        @type unique: boolean
+        @param max_agenda: Number of partial paths to keep when the
+                           agenda is pruned (or None for no limit)
+        @type max_agenda: int
+        @return: Generator of (score, path) tuples, where path is the
+                 list of nodes from C{start} to C{end}
+        @rtype: generator of (float, list of Dag.Node)
+        """
+        if start == None:
+            start = self.start
+        if end == None:
+            end = self.end
+        filler = symtab.filler
+        sentmark = symtab.sentmark
+        base = symtab.base
+        basesym = symtab.basesym
+        def lmscore(v, u, p):
+            if lm == None:
+                return 0
+            elif p == None:
+                return lm.score(basesym[v.wid], basesym[u.wid])[0]
+            else:
+                return lm.score(basesym[v.wid], basesym[u.wid],
+                                basesym[p.wid])[0]
+        def history(p):
+            # Key for the heuristic of a node preceded by p
+            if lm == None or p == None:
+                return None
+            return base[p.wid]
+        # Backward Viterbi pass to find the heuristic score for each
+        # node which can reach the end (without passing through
+        # fillers), for each word which can precede it
+        heuristic = {end: None}
+        for u in reversed(self.topo_nodes()):
+            if u == end or (filler[u.wid] and u != start):
+                continue
+            # Possible predecessors of u in a path (one per word)
+            if u == start or lm == None:
+                preds = [None]
+            else:
+                preds = dict([(base[x.src.wid], x.src)
+                              for x in u.entries]).values()
+            best = {}
+            for x in u.exits:
+                if x.dest not in heuristic:
+                    continue
+                if x.dest == end:
+                    rest = x.ascr
+                else:
+                    rest = x.ascr + heuristic[x.dest][history(u)]
+                for p in preds:
+                    score = rest + lmscore(x.dest, u, p)
+                    h = history(p)
+                    if h not in best or score > best[h]:
+                        best[h] = score
+            if best:
+                heuristic[u] = best
+        if start not in heuristic:
+            return
+        # Agenda of partial paths, ordered by score plus heuristic.
+        # Paths are linked lists of (node, rest of path) in reverse.
+        Q = [(-heuristic[start][None], 0, 0, start, None)]
+        count = 1
+        seen = {}
+        while Q:
+            f, c, score, u, prefix = heapq.heappop(Q)
+            path = (u, prefix)
+            if u == end:
+                nodes = []
+                while path:
+                    nodes.append(path[0])
+                    path = path[1]
+                nodes.reverse()
+                if unique:
+                    words = tuple([basesym[v.wid] for v in nodes
+                                   if not (filler[v.wid] or sentmark[v.wid])])
+                    if words in seen:
+                        continue
+                    seen[words] = 1
+                yield score, nodes
+                continue
+            if prefix == None:
+                p = None
+            else:
+                p = prefix[0]
+            h = history(u)
+            for x in u.exits:
+                if x.dest not in heuristic:
+                    continue
+                pscore = score + x.ascr + lmscore(x.dest, u, p)
+                if x.dest == end:
+                    rest = 0
+                else:
+                    rest = heuristic[x.dest][h]
+                heapq.heappush(Q, (-(pscore + rest), count,
+                                   pscore, x.dest, path))
+                count += 1
+            if max_agenda != None and len(Q) > 2 * max_agenda:
+                # A sorted list is also a heap
+                Q = heapq.nsmallest(max_agenda, Q)
+
     def node_range(self, start, end):
         """Return all nodes starting in a certain time range."""
-        return [n for n in self.nodes
-                if n.entry >= start
-                and n.entry < end]
+        return self.time_index().node_range(start, end)
 
     def edge_slice(self, time):
         """Return all edges active at a certain time point."""
@@ -535,9 +1144,7 @@ class Dag(object):
 
     def edge_range(self, start, end):
         """Return all edges active in a certain time range."""
-        return [e for e in self.edges()
-                if e.src.entry <= end
-                and e.dest.entry > start]
+        return self.time_index().edge_range(start, end)
 
     def traverse_depth(self, start=None):
         """Depth-first traversal of DAG nodes"""
@@ -561,8 +1168,8 @@ class Dag(object):
         """Breadth-first traversal of DAG nodes"""
         if start == None:
             start = self.start
-        # Initialize the agenda (set of active nodes)
-        roots = [start]
+        # Initialize the agenda (queue of active nodes)
+        roots = collections.deque([start])
         # Keep a table of already seen nodes
         seen = {start:1}
         # Repeatedly pop the first one off of the agenda and shift
@@ -571,7 +1178,7 @@ class Dag(object):
             r = roots.pop()
             for x in r.exits:
                 if x.dest not in seen:
-                    roots.insert(0, x.dest)
+                    roots.appendleft(x.dest)
                     seen[x.dest] = 1
             yield r
 
@@ -579,8 +1186,8 @@ class Dag(object):
         """Breadth-first reverse traversal of DAG nodes"""
         if end == None:
             end = self.end
-        # Initialize the agenda (set of active nodes)
-        roots = [end]
+        # Initialize the agenda (queue of active nodes)
+        roots = collections.deque([end])
         # Keep a table of already seen nodes
         seen = {end:1}
         # Repeatedly pop the first one off of the agenda and shift
@@ -589,22 +1196,32 @@ class Dag(object):
             r = roots.pop()
             for v in r.entries:
                 if v.src not in seen:
-                    roots.insert(0, v.src)
+                    roots.appendleft(v.src)
                 seen[v.src] = 1
             yield r
 
     def update_link(self, src, dest, ascr):
         """Add a link from src to dest if none exists, or update the
         acoustic score if one does and ascr is better."""
-        for x in src.exits:
-            if x.dest == dest:
-                if ascr > x.ascr:
-                    x.ascr = ascr
-                # Found a link, return
-                return x.ascr
+        if self._linkindex == None:
+            self._linkindex = {}
+            for u in self.nodes:
+                for x in u.exits:
+                    self._linkindex.setdefault((u, x.dest), x)
+        x = self._linkindex.get((src, dest))
+        if x != None:
+            if ascr > x.ascr:
+                x.ascr = ascr
+            # Found a link, return
+            return x.ascr
         link = self.Link(src, dest, ascr)
         src.exits.append(link)
         dest.entries.append(link)
+        # Other indexes are now stale, but the link index is not
+        linkindex = self._linkindex
+        self.invalidate()
+        self._linkindex = linkindex
+        linkindex[src, dest] = link
 
     def bypass_fillers(self, lm=None, silprob=0.1, fillprob=0.1):
         """Add links to bypass filler nodes."""
@@ -614,63 +1231,173 @@ class Dag(object):
         else:
             silpen = math.log(silprob)
             fillpen = math.log(fillprob)
+        filler = symtab.filler
         def fill_score(link):
-            if link.dest.sym == '<sil>':
+            if link.dest.wid == symtab.sil:
                 return link.ascr + silpen
             else:
                 return link.ascr + fillpen
-        # Do transitive closure on filler nodes
+        def is_bypassed(u):
+            return filler[u.wid] and u != self.end
+        # Transitive closure of each filler node: the best score to
+        # each non-filler node reachable through it, in the order in
+        # which a depth-first search would first find them.
+        closure = {}
+        def close(f):
+            stack = [f]
+            while stack:
+                u = stack[-1]
+                pending = [x.dest for x in u.exits
+                           if is_bypassed(x.dest) and x.dest not in closure]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                if u in closure:
+                    continue
+                order = []
+                best = {}
+                for x in u.exits:
+                    if not is_bypassed(x.dest):
+                        if x.dest not in best:
+                            order.append(x.dest)
+                            best[x.dest] = x.ascr
+                        elif x.ascr > best[x.dest]:
+                            best[x.dest] = x.ascr
+                for x in reversed(u.exits):
+                    if is_bypassed(x.dest):
+                        fscr = fill_score(x)
+                        dorder, dbest = closure[x.dest]
+                        for v in dorder:
+                            if v not in best:
+                                order.append(v)
+                                best[v] = fscr + dbest[v]
+                            elif fscr + dbest[v] > best[v]:
+                                best[v] = fscr + dbest[v]
+                closure[u] = (order, best)
+            return closure[f]
         for n in self.nodes:
-            if is_filler(n.sym) and n != self.start:
+            if filler[n.wid] and n != self.start:
                 continue
-            # Traverse the outgoing filler links until all non-fillers
-            # are reached.
-            agenda = []
-            leaves = []
-            for nx in n.exits:
-                if is_filler(nx.dest.sym) and nx.dest != self.end:
-                    fscr = fill_score(nx)
-                    agenda.append((nx, fscr))
-            while len(agenda):
-                link, fscr = agenda.pop()
-                for nx in link.dest.exits:
-                    if is_filler(nx.dest.sym) and nx.dest != self.end:
-                        fscr2 = fill_score(nx)
-                        agenda.append((nx, fscr + fscr2))
-                    else:
-                        self.update_link(n, nx.dest, fscr + nx.ascr)
+            # Link to all non-fillers reached through outgoing filler links
+            for nx in reversed([nx for nx in n.exits if is_bypassed(nx.dest)]):
+                fscr = fill_score(nx)
+                order, best = close(nx.dest)
+                for v in order:
+                    self.update_link(n, v, fscr + best[v])
 
     def remove_unreachable(self):
-        """Remove unreachable nodes and dangling edges."""
-        # Mark reachable nodes from the end
-        for w in self.reverse_breadth():
-            w.score = 42
-        # Find and remove unreachable ones, renumber remaining ones
-        begone = {}
-        newnodes = []
+        """
+        Remove nodes which cannot be reached from the start node or
+        which cannot reach the end node, along with all links to and
+        from them.  Nodes are compacted in place and renumbered, but
+        their search fields (C{score}, C{prev}) are left alone.
+
+        @return: New index of each node in C{nodes}, or -1 if it was
+                 removed
+        @rtype: list of int
+        """
+        index = {}
         for i, w in enumerate(self.nodes):
-            if w.score == 42:
-                w.id = len(newnodes)
-                newnodes.append(w)
+            index[w] = i
+        n = len(self.nodes)
+        # Mark nodes reachable from the start and from the end
+        fwd = [False] * n
+        bwd = [False] * n
+        if self.start in index:
+            fwd[index[self.start]] = True
+            agenda = [self.start]
+            while agenda:
+                for x in agenda.pop().exits:
+                    i = index[x.dest]
+                    if not fwd[i]:
+                        fwd[i] = True
+                        agenda.append(x.dest)
+        if self.end in index:
+            bwd[index[self.end]] = True
+            agenda = [self.end]
+            while agenda:
+                for x in agenda.pop().entries:
+                    i = index[x.src]
+                    if not bwd[i]:
+                        bwd[i] = True
+                        agenda.append(x.src)
+        # Compact the node list, renumbering remaining nodes
+        remap = [-1] * n
+        begone = {}
+        j = 0
+        for i in range(n):
+            w = self.nodes[i]
+            if fwd[i] and bwd[i]:
+                remap[i] = w.id = j
+                self.nodes[j] = w
+                j += 1
             else:
                 begone[w] = 1
-        self.nodes = newnodes
-        # Remove links to unreachable nodes
-        for w in self.nodes:
-            newexits = []
-            for x in w.exits:
-                if x.dest in begone:
-                    pass
-                else:
-                    newexits.append(x)
-            w.exits = newexits
-            newentries = []
+        if not begone:
+            return remap
+        del self.nodes[j:]
+        self.invalidate()
+        # Remove links to unreachable nodes from the remaining ones
+        dirty = {}
+        for w in begone:
             for x in w.entries:
-                if x.src in begone:
-                    pass
-                else:
-                    newentries.append(x)
-            w.entries = newentries
+                if x.src not in begone:
+                    dirty[x.src] = 1
+            for x in w.exits:
+                if x.dest not in begone:
+                    dirty[x.dest] = 1
+        for w in dirty:
+            w.exits[:] = [x for x in w.exits if x.dest not in begone]
+            w.entries[:] = [x for x in w.entries if x.src not in begone]
+        return remap
+
+    def prune(self, beam=10.0, lm=None, lw=1.0, aw=1.0, max_edges=None):
+        """
+        Remove links whose posterior probability is far below that of
+        the best path, and then any nodes and links which are no
+        longer on a path from start to end.
+
+        Link posteriors are computed with L{posterior}, and links on
+        the path with the highest product of link posteriors are
+        always kept.
+
+        @param beam: Prune links whose posterior log-probability is
+                     more than this below the best one
+        @type beam: float
+        @param lm: Language model to use in computing posteriors
+        @type lm: sphinxbase.ngram_model.NGramModel (or equivalent)
+        @param max_edges: Keep at most this many links starting in
+                          any one frame (the most probable ones)
+        @type max_edges: int
+        @return: Number of nodes and links before and after pruning
+        @rtype: (int, int, int, int)
+        """
+        n_nodes, n_edges = self.n_nodes(), self.n_edges()
+        self.posterior(lm, lw, aw)
+        keep = {}
+        best = ConfusionNetwork.best_posterior_path(self)
+        for u, v in zip(best[:-1], best[1:]):
+            for x in u.exits:
+                if x.dest == v:
+                    keep[x] = 1
+        thresh = max([LOGZERO] + [x.post for x in self.edges()]) - beam
+        byframe = {}
+        for x in self.edges():
+            if x.post >= thresh:
+                byframe.setdefault(x.src.entry, []).append(x)
+        for links in byframe.itervalues():
+            if max_edges != None and len(links) > max_edges:
+                links.sort(lambda x,y: cmp(y.post, x.post))
+                del links[max_edges:]
+            for x in links:
+                keep[x] = 1
+        for u in self.nodes:
+            u.exits[:] = [x for x in u.exits if x in keep]
+            u.entries[:] = [x for x in u.entries if x in keep]
+        self.invalidate()
+        self.remove_unreachable()
+        return n_nodes, n_edges, self.n_nodes(), self.n_edges()
 
     def traverse_edges_breadth(self, start=None, end=None):
         """
@@ -684,10 +1411,9 @@ class Dag(object):
         if start == None: start = self.start
         if end == None: end = self.end
         # Agenda of closed edges
-        Q = start.exits[:]
+        Q = collections.deque(start.exits)
         while Q:
-            e = Q[0]
-            del Q[0]
+            e = Q.popleft()
             yield e
             e.dest.fan -= 1
             if e.dest.fan == 0:
@@ -708,10 +1434,9 @@ class Dag(object):
         if start == None: start = self.start
         if end == None: end = self.end
         # Agenda of closed edges
-        Q = end.entries[:]
+        Q = collections.deque(end.entries)
         while Q:
-            e = Q[0]
-            del Q[0]
+            e = Q.popleft()
             yield e
             e.src.fan -= 1
             if e.src.fan == 0:
@@ -719,6 +1444,69 @@ class Dag(object):
                     break
                 Q.extend(e.src.entries)
             
+    def topo_nodes(self):
+        """
+        Return the nodes in topological order, computing it if
+        necessary.  This is the order of C{nodes} if every link
+        already goes forward in it (as it does after
+        L{sort_nodes_forward} unless some link goes backward in time).
+
+        The returned list is cached and should not be modified.
+
+        @rtype: list of Dag.Node
+        """
+        if self._nodeorder == None:
+            index = {}
+            for i, u in enumerate(self.nodes):
+                index[u] = i
+            backward = False
+            for u in self.nodes:
+                for x in u.exits:
+                    if index[x.dest] <= index[u]:
+                        backward = True
+            if not backward:
+                self._nodeorder = list(self.nodes)
+            else:
+                # Kahn's algorithm, taking ready nodes in node order
+                fan = dict([(u, len(u.entries)) for u in self.nodes])
+                Q = collections.deque([u for u in self.nodes if fan[u] == 0])
+                order = []
+                while Q:
+                    u = Q.popleft()
+                    order.append(u)
+                    for x in u.exits:
+                        fan[x.dest] -= 1
+                        if fan[x.dest] == 0:
+                            Q.append(x.dest)
+                self._nodeorder = order
+        return self._nodeorder
+
+    def topo_edges(self):
+        """
+        Return the edges in the order of L{traverse_edges_breadth}
+        from the start to the end node, computing it if necessary.
+
+        The returned list is cached and should not be modified.
+
+        @rtype: list of Dag.Link
+        """
+        if self._edgeorder == None:
+            self._edgeorder = list(self.traverse_edges_breadth())
+        return self._edgeorder
+
+    def reverse_topo_edges(self):
+        """
+        Return the edges in the order of L{reverse_edges_breadth}
+        from the end to the start node, computing it if necessary.
+
+        The returned list is cached and should not be modified.
+
+        @rtype: list of Dag.Link
+        """
+        if self._redgeorder == None:
+            self._redgeorder = list(self.reverse_edges_breadth())
+        return self._redgeorder
+
     def forward(self, lm=None, lw=1.0, aw=1.0):
         """
         Compute forward variable for all arcs in the lattice.
@@ -726,7 +1514,7 @@ class Dag(object):
         @param lm: Language model to use in computation
         @type lm: sphinxbase.ngram_model (or equivalent)
         """
-        for wx in self.traverse_edges_breadth():
+        for wx in self.topo_edges():
             # This is alpha_t(w)
             wx.alpha = LOGZERO
             # If wx.src has no predecessors the previous alpha is 1.0
@@ -736,8 +1524,8 @@ class Dag(object):
             for vx in wx.src.entries:
                 # Get unscaled language model score P(w|v) (bigrams only for now...)
                 if lm:
-                    lscr = lm.prob(baseword(wx.src.sym),
-                                   baseword(vx.src.sym))[0] * lw
+                    lscr = lm.prob(symtab.basesym[wx.src.wid],
+                                   symtab.basesym[vx.src.wid])[0] * lw
                 else:
                     lscr = 0
                 # Accumulate alpha for this arc
@@ -750,7 +1538,7 @@ class Dag(object):
         @param lm: Language model to use in computation
         @type lm: sphinxbase.ngram_model.NGramModel (or equivalent)
         """
-        for vx in self.reverse_edges_breadth():
+        for vx in self.reverse_topo_edges():
             # Beta for arcs into </s> = 1.0
             if vx.dest == self.end:
                 vx.beta = 0
@@ -758,8 +1546,8 @@ class Dag(object):
                 vx.beta = LOGZERO
                 # Get unscaled language model probability P(w|v) (bigrams only for now...)
                 if lm:
-                    lscr = lm.prob(baseword(vx.dest.sym),
-                                   baseword(vx.src.sym))[0] * lw
+                    lscr = lm.prob(symtab.basesym[vx.dest.wid],
+                                   symtab.basesym[vx.src.wid])[0] * lw
                 else:
                     lscr = 0
                 # For each outgoing arc from vx.dest
@@ -790,6 +1578,158 @@ class Dag(object):
             for wx in w.exits:
                 wx.post = wx.alpha + wx.beta - norm
 
+    def forward_tg(self, lm=None, lw=1.0, aw=1.0, max_states=1000000):
+        """
+        Compute forward variable for all arcs in the lattice using
+        trigrams.
+
+        Since the trigram probability of a word depends on the two
+        words before it, each node is expanded into one state for each
+        distinct word preceding it, merging all paths into the node
+        which share that word.  If this would create more than
+        C{max_states} states, only the most probable preceding words
+        are kept for each node, and the remaining paths are merged
+        into a single state, from which bigram probabilities are used.
+
+        @param lm: Language model to use in computation
+        @type lm: sphinxbase.ngram_model (or equivalent)
+        @param max_states: Maximum number of expanded states
+        @type max_states: int
+        @return: Log-probability of all paths ending in each node
+                 (including the language model probability of its
+                 word) for each preceding base word ID, or C{None} for
+                 merged histories and for nodes with no predecessors
+        @rtype: dict of Dag.Node -> dict of int -> float
+        """
+        base = symtab.base
+        basesym = symtab.basesym
+        syms = symtab.syms
+        order = self.topo_nodes()
+        # Find how many histories each node can keep
+        nhist = [len(dict([(base[vx.src.wid], 1) for vx in u.entries]))
+                 for u in order]
+        limit = max(nhist + [1])
+        if sum(nhist) > max_states:
+            lo, hi = 1, limit
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if sum([min(h, mid) for h in nhist]) <= max_states:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            limit = lo
+        alpha = {}
+        for u in order:
+            # If u has no predecessors the previous alpha is 1.0
+            if len(u.entries) == 0:
+                states = {None: 0}
+            else:
+                states = {}
+                w = basesym[u.wid]
+                for vx in u.entries:
+                    v = base[vx.src.wid]
+                    for h, a in alpha[vx.src].iteritems():
+                        # Get unscaled language model score P(w|v,h)
+                        if not lm:
+                            lscr = 0
+                        elif h == None:
+                            lscr = lm.prob(w, syms[v])[0] * lw
+                        else:
+                            lscr = lm.prob(w, syms[v], syms[h])[0] * lw
+                        states[v] = logadd(states.get(v, LOGZERO),
+                                           a + vx.ascr * aw + lscr)
+                # Merge all but the most probable histories
+                if len(states) > limit:
+                    ranked = states.items()
+                    ranked.sort(lambda x,y: cmp(y[1], x[1]))
+                    states = dict(ranked[:limit-1])
+                    merged = LOGZERO
+                    for v, a in ranked[limit-1:]:
+                        merged = logadd(merged, a)
+                    states[None] = merged
+            alpha[u] = states
+            total = LOGZERO
+            for a in states.itervalues():
+                total = logadd(total, a)
+            for wx in u.exits:
+                wx.alpha = total + wx.ascr * aw
+        return alpha
+
+    def backward_tg(self, alpha, lm=None, lw=1.0, aw=1.0):
+        """
+        Compute backward variable for all arcs in the lattice using
+        trigrams, over the states found by L{forward_tg}.
+
+        Since the backward probability of an arc depends on the
+        history of its start node, C{beta} for each arc is averaged
+        over these histories, weighted by their forward
+        probabilities, so that C{alpha + beta} is the log-probability
+        of all paths through the arc.
+
+        @param alpha: States returned by L{forward_tg}
+        @type alpha: dict of Dag.Node -> dict of int -> float
+        @param lm: Language model to use in computation
+        @type lm: sphinxbase.ngram_model.NGramModel (or equivalent)
+        """
+        base = symtab.base
+        basesym = symtab.basesym
+        syms = symtab.syms
+        # Log-probability of all paths following each node, for each
+        # of its histories
+        beta = {}
+        for u in reversed(self.topo_nodes()):
+            w = base[u.wid]
+            beta[u] = dict([(h, LOGZERO) for h in alpha[u]])
+            for vx in u.exits:
+                dest = vx.dest
+                # Beta for arcs into </s> = 1.0
+                if dest == self.end:
+                    after = 0
+                else:
+                    after = beta[dest].get(w, beta[dest].get(None))
+                # Beta and joint probability of vx for each history
+                vx.beta = LOGZERO
+                total = LOGZERO
+                for h, a in alpha[u].iteritems():
+                    # Get unscaled language model probability P(x|w,h)
+                    if not lm or dest == self.end:
+                        lscr = 0
+                    elif h == None:
+                        lscr = lm.prob(basesym[dest.wid], syms[w])[0] * lw
+                    else:
+                        lscr = lm.prob(basesym[dest.wid], syms[w], syms[h])[0] * lw
+                    b = lscr + after
+                    beta[u][h] = logadd(beta[u][h], b + vx.ascr * aw)
+                    vx.beta = logadd(vx.beta, a + b)
+                    total = logadd(total, a)
+                vx.beta -= total
+
+    def posterior_tg(self, lm=None, lw=1.0, aw=1.0, max_states=1000000):
+        """
+        Compute arc posterior probabilities using trigrams.
+
+        @param lm: Language model to use in computation
+        @type lm: sphinxbase.ngram_model.NGramModel (or equivalent)
+        @param max_states: Maximum number of expanded states (see
+                           L{forward_tg})
+        @type max_states: int
+        """
+        # Clear alphas, betas, and posteriors
+        for w in self.nodes:
+            for wx in w.exits:
+                wx.alpha = wx.beta = wx.post = LOGZERO
+        # Run forward and backward
+        alpha = self.forward_tg(lm, lw, aw, max_states)
+        self.backward_tg(alpha, lm, lw, aw)
+        # Sum over alpha for arcs entering the end node to get normalizer
+        norm = LOGZERO
+        for vx in self.end.entries:
+            norm = logadd(norm, vx.alpha)
+        # Iterate over all arcs and normalize
+        for w in self.nodes:
+            for wx in w.exits:
+                wx.post = wx.alpha + wx.beta - norm
+
     def best_posterior(self, node, start=None, end=None, wlen=0.4):
         """
         Find the maximum local posterior probability estimate for node.
@@ -808,87 +1748,151 @@ class Dag(object):
         window = int((end - start) * wlen)
         ws = max(start - window, 0)
         we = min(end + window, self.n_frames)
+        # Only look at edges for the same base word
+        index = self.time_index(symtab.base[node.wid])
         return max([LOGZERO]
-                   + [x.post for x in self.edge_range(ws, we)
-                      if (baseword(x.src.sym) == baseword(node.sym))])
+                   + [x.post for x in index.edge_range(ws, we)])
+
+    def confusion_network(self, pivot=None):
+        """
+        Build a confusion network from the link posteriors, which
+        must already have been computed with L{posterior} (or
+        L{posterior_tg}).
+
+        @param pivot: Path whose words define the initial slots (see
+                      L{ConfusionNetwork})
+        @type pivot: list of Dag.Node
+        @rtype: ConfusionNetwork
+        """
+        return ConfusionNetwork(self, pivot)
 
     def minimum_error(self, hyp):
         """
         Find the minimum word error rate path through lattice,
         returning the number of errors and an alignment.
+
+        Each row of the alignment matrix (one per reference word) is
+        computed with array operations over a CSR table of node
+        predecessors, and backpointers are kept as integer arrays.
+
+        If the reference is empty (or only has filler words), every
+        word on the path through the lattice with the fewest words is
+        an insertion.
+
         @return: Tuple of (error-count, alignment of (hyp, ref) pairs)
         @rtype: (int, list(string, string))
         """
-        # Initialize the alignment matrix
-        align_matrix = numpy.ones((len(hyp),len(self.nodes)), 'i') * 999999999
-        # And the backpointer matrix
-        bp_matrix = numpy.zeros((len(hyp),len(self.nodes)), 'O')
+        INF = 999999999
         # Remove filler nodes from the reference
         hyp = filter(lambda x: not is_filler(x), hyp)
+        # Compare base word IDs rather than strings
+        base = symtab.base
+        basesym = symtab.basesym
+        hypbase = [base[symtab.intern(w)] for w in hyp]
         # Bypass filler nodes in the lattice
         self.bypass_fillers()
         # Figure out the minimum distance to each node from the start
         # of the lattice, and construct a node to ID mapping
         nodeid = {}
         for i,u in enumerate(self.nodes):
-            u.score = 999999999
+            u.score = INF
             nodeid[u] = i
         self.start.score = 1
         for u in self.nodes:
-            if is_filler(u.sym):
+            if symtab.filler[u.wid]:
                 continue
             for x in u.exits:
                 dist = u.score + 1
                 if dist < x.dest.score:
                     x.dest.score = dist
-        def find_pred(ii, jj):
-            bestscore = 999999999
-            bestp = -1
-            if len(self.nodes[jj].entries) == 0:
+        if not hyp:
+            if self.end.score == INF:
+                raise ValueError("No path to final node")
+            # Backtrace along the path with the fewest words
+            bt = []
+            u = self.end
+            while True:
+                bt.append(('INS', basesym[u.wid]))
+                if u == self.start:
+                    break
+                for x in u.entries:
+                    if (not symtab.filler[x.src.wid]
+                        and x.src.score == u.score - 1):
+                        u = x.src
+                        break
+            bt.reverse()
+            return self.end.score, bt
+        n_nodes = len(self.nodes)
+        score = numpy.array([u.score for u in self.nodes], 'i')
+        nodebase = numpy.array([base[u.wid] for u in self.nodes], 'i')
+        startid = nodeid[self.start]
+        # Predecessors of each node, in CSR form (in order of entries)
+        pred_count = numpy.array([len(u.entries) for u in self.nodes], 'i')
+        pred_count[startid] = 0
+        pred_src = numpy.array([nodeid[x.src] for u in self.nodes
+                                if u != self.start
+                                for x in u.entries], 'i')
+        has_pred = pred_count > 0
+        seg = (numpy.cumsum(pred_count) - pred_count)[has_pred]
+        posn = numpy.arange(len(pred_src))
+        nodes = numpy.arange(n_nodes)
+        def find_pred(row):
+            # First predecessor of each node with the lowest cost in
+            # row, or -1 if there is none
+            bestp = numpy.zeros(n_nodes, 'i') - 1
+            bestscore = numpy.zeros(n_nodes, 'i') + INF
+            if len(pred_src) == 0:
                 return bestp, bestscore
-            for e in self.nodes[jj].entries:
-                k = nodeid[e.src]
-                if align_matrix[ii,k] < bestscore:
-                    bestp = k
-                    bestscore = align_matrix[ii,k]
+            vals = row[pred_src]
+            mins = numpy.minimum.reduceat(vals, seg)
+            first = numpy.minimum.reduceat(
+                numpy.where(vals == mins.repeat(pred_count[has_pred]),
+                            posn, len(posn)), seg)
+            bestp[has_pred] = numpy.where(mins < INF, pred_src[first], -1)
+            bestscore[has_pred] = mins
             return bestp, bestscore
-        # Now fill in the alignment matrix
-        for i, w in enumerate(hyp):
-            for j, u in enumerate(self.nodes):
-                # Insertion = cost(w, prev(u)) + 1
-                if u == self.start: # start node
-                    bestp = -1
-                    inscost = i + 2 # Distance from start of ref
-                else:
-                    # Find best predecessor in the same reference position
-                    bestp, bestscore = find_pred(i, j)
-                    inscost = align_matrix[i,bestp] + 1
-                # Deletion  = cost(prev(w), u) + 1
-                if i == 0: # start symbol
-                    delcost = u.score + 1 # Distance from start of hyp
-                else:
-                    delcost = align_matrix[i-1,j] + 1
+        align_matrix = numpy.zeros((len(hyp), n_nodes), 'i') + INF
+        bp_i = numpy.zeros((len(hyp), n_nodes), 'i')
+        bp_j = numpy.zeros((len(hyp), n_nodes), 'i')
+        first_bp = None
+        for i, w in enumerate(hypbase):
+            cost = (nodebase != w).astype('i')
+            # Deletion = cost(prev(w), u) + 1
+            if i == 0:
+                delcost = score + 1 # Distance from start of hyp
+            else:
+                prev = align_matrix[i-1]
+                delcost = prev + 1
                 # Substitution = cost(prev(w), prev(u)) + (w != u)
-                if i == 0 and bestp == -1: # Start node, start of ref
-                    subcost = int(baseword(w) != baseword(u.sym))
-                elif i == 0: # Start of ref
-                    subcost = (self.nodes[bestp].score
-                               + int(baseword(w) != baseword(u.sym)))
-                elif bestp == -1: # Start node
-                    subcost = i - 1 + int(baseword(w) != baseword(u.sym))
-                else:
-                    # Find best predecessor in the previous reference position
-                    bestp, bestscore = find_pred(i-1, j)
-                    subcost = (align_matrix[i-1,bestp]
-                               + int(baseword(w) != baseword(u.sym)))
-                align_matrix[i,j] = min(subcost, inscost, delcost)
-                # Now find the argmin
-                if align_matrix[i,j] == subcost:
-                    bp_matrix[i,j] = (i-1, bestp)
-                elif align_matrix[i,j] == inscost:
-                    bp_matrix[i,j] = (i, bestp)
-                else:
-                    bp_matrix[i,j] = (i-1, j)
+                subp, subscore = find_pred(prev)
+                subp[startid] = -1
+                subcost = numpy.where(subp == -1, i + cost,
+                                      prev[subp] + cost)
+            # Insertion = cost(w, prev(u)) + 1, which depends on this
+            # row, so relax it until nothing changes
+            row = delcost
+            while True:
+                insp, insscore = find_pred(row)
+                insp[startid] = -1
+                inscost = numpy.where(insp == -1, INF + 1, row[insp] + 1)
+                inscost[startid] = i + 2 # Distance from start of ref
+                if i == 0:
+                    subp = insp
+                    subcost = numpy.where(insp == -1, cost,
+                                          score[insp] + cost)
+                newrow = numpy.minimum(numpy.minimum(subcost, inscost),
+                                       delcost)
+                if (newrow == row).all():
+                    break
+                row = newrow
+            align_matrix[i] = row
+            # Now find the argmin
+            is_sub = row == subcost
+            is_ins = (row == inscost) & ~is_sub
+            bp_i[i] = numpy.where(is_ins, i, i - 1)
+            bp_j[i] = numpy.where(is_sub, subp, numpy.where(is_ins, insp, nodes))
+            if i == 0:
+                first_bp = insp
         # Find last node's index
         last = nodeid[self.end]
         # Backtrace to get an alignment
@@ -896,21 +1900,21 @@ class Dag(object):
         j = last
         bt = []
         while True:
-            ip,jp = bp_matrix[i,j]
+            ip,jp = bp_i[i,j], bp_j[i,j]
             if ip == i: # Insertion
-                bt.append(('INS', baseword(self.nodes[j].sym)))
+                bt.append(('INS', basesym[self.nodes[j].wid]))
             elif jp == j: # Deletion
                 bt.append((hyp[i], 'DEL'))
             else:
-                bt.append((hyp[i], baseword(self.nodes[j].sym)))
+                bt.append((hyp[i], basesym[self.nodes[j].wid]))
             # If we consume both ref and hyp, we are done
             if ip == -1 and jp == -1:
                 break
             # If we hit the beginning of the ref, fill with insertions
             if ip == -1:
                 while True:
-                    bt.append(('INS', baseword(self.nodes[jp].sym)))
-                    bestp, bestscore = find_pred(i,jp)
+                    bt.append(('INS', basesym[self.nodes[jp].wid]))
+                    bestp = first_bp[jp]
                     if bestp == -1:
                         break
                     jp = bestp
@@ -926,51 +1930,1057 @@ class Dag(object):
         bt.reverse()
         return align_matrix[-1,last], bt
 
-def forward_tg(self, lm=None, lw=1.0, aw=1.0):
+class IncrementalDag(Dag):
     """
-    Compute forward variable for all arcs in the lattice using trigrams.
+    DAG which is built incrementally as the decoder produces it.
+
+    Nodes are added in order of their entry frame and links in order
+    of the entry frame of their destination node, so that all links
+    into a node have been added before any link out of it.  As each
+    link is added, its forward probability (C{alpha}, as computed by
+    L{Dag.forward}) and the Viterbi score and backpointer of its
+    destination (as computed by L{Dag.bestpath}, but with filler words
+    scored by a fixed penalty rather than bypassed) are updated, so
+    the best partial hypothesis and its confidence can be found at any
+    time without searching the lattice from the start.
 
-    @param lm: Language model to use in computation
-    @type lm: sphinxbase.ngram_model (or equivalent)
+    @ivar frontier: Latest destination frame of any link
+    @type frontier: int
     """
-    for wx in self.traverse_edges_breadth():
-        # We keep a separate alpha for each trigram history
-        # This is alpha_t(w)
-        wx.alpha = LOGZERO
-        # If wx.src has no predecessors the previous alpha is 1.0
-        if len(wx.src.entries) == 0:
-            wx.alpha = wx.ascr * aw
-        # For each predecessor node to wx.src
-        for vx in wx.src.entries:
-            # Get unscaled language model score P(w|v) (bigrams only for now...)
-            if lm:
-                lscr = lm.prob(baseword(wx.src.sym),
-                               baseword(vx.src.sym))[0] * lw
+    def __init__(self, lm=None, lw=1.0, aw=1.0, fillprob=0.1,
+                 frate=100, start_sym='<s>'):
+        """
+        Create an incremental DAG containing only a start node.
+
+        @param lm: Language model to use in search and posteriors
+        @type lm: sphinxbase.ngram_model.NGramModel (or equivalent)
+        @param lw: Language model weight for posteriors
+        @type lw: float
+        @param aw: Acoustic weight for posteriors
+        @type aw: float
+        @param fillprob: Probability of inserting a filler word in search
+        @type fillprob: float
+        """
+        Dag.__init__(self, frate=frate)
+        self.lm = lm
+        self.lw = lw
+        self.aw = aw
+        if lm:
+            self.fillpen = math.log(fillprob) * lm.lw + math.log(lm.wip)
+        else:
+            self.fillpen = math.log(fillprob)
+        self.header = {}
+        self.getcwd = os.getcwd()
+        self.n_frames = 0
+        self.frontier = 0
+        self.start = self.Node(start_sym, 0, 0)
+        self.start.score = 0
+        self.end = None
+        self.nodes = [self.start]
+        # Forward probability of all paths into each node, including
+        # the language model probability of its word
+        self._alpha = {}
+        # Last two non-filler words on the best path to each node
+        self._history = {self.start: (symtab.basesym[self.start.wid],)}
+
+    def add_node(self, sym, entry):
+        """
+        Add a node to the DAG.
+
+        @param sym: Word for the node
+        @type sym: string
+        @param entry: Entry frame, which must be no earlier than that
+                      of any node already added
+        @type entry: int
+        @rtype: Dag.Node
+        """
+        if entry < self.nodes[-1].entry:
+            raise ValueError("Node at frame %d added after frame %d"
+                             % (entry, self.nodes[-1].entry))
+        u = self.Node(sym, entry, len(self.nodes))
+        self.nodes.append(u)
+        self.invalidate()
+        return u
+
+    def add_link(self, src, dest, ascr):
+        """
+        Add a link to the DAG, updating forward probabilities and
+        Viterbi scores.
+
+        @param src: Start node, which must precede C{dest} in time
+        @type src: Dag.Node
+        @param dest: End node, whose entry frame must be no earlier
+                     than that of the end node of any link already
+                     added
+        @type dest: Dag.Node
+        @param ascr: Acoustic score
+        @type ascr: float
+        @rtype: Dag.Link
+        """
+        if dest.entry <= src.entry:
+            raise ValueError("Link from frame %d to %d does not go forward"
+                             % (src.entry, dest.entry))
+        if dest.entry < self.frontier:
+            raise ValueError("Link to frame %d added after frame %d"
+                             % (dest.entry, self.frontier))
+        x = self.Link(src, dest, ascr)
+        src.exits.append(x)
+        dest.entries.append(x)
+        self.frontier = self.n_frames = dest.entry
+        self.invalidate()
+        lm = self.lm
+        # Forward probability (as in Dag.forward)
+        if src.entries:
+            x.alpha = self._alpha[src] + ascr * self.aw
+        else:
+            x.alpha = ascr * self.aw
+        if lm:
+            lscr = lm.prob(symtab.basesym[dest.wid],
+                           symtab.basesym[src.wid])[0] * self.lw
+        else:
+            lscr = 0
+        self._alpha[dest] = logadd(self._alpha.get(dest, LOGZERO),
+                                       x.alpha + lscr)
+        # Viterbi score (as in Dag.bestpath)
+        if src.prev == None and src != self.start:
+            return x # Not reachable from start
+        if symtab.filler[dest.wid]:
+            x.lscr, x.lback = self.fillpen, 0
+        elif lm:
+            x.lscr, x.lback = lm.score(symtab.basesym[dest.wid],
+                                       *self._history[src])
+        else:
+            x.lscr, x.lback = 0, 0
+        x.pscr = src.score + ascr + x.lscr
+        if x.pscr > dest.score:
+            dest.score = x.pscr
+            dest.prev = src
+            if symtab.filler[dest.wid]:
+                self._history[dest] = self._history[src]
+            else:
+                self._history[dest] = ((symtab.basesym[dest.wid],)
+                                      + self._history[src][:1])
+        return x
+
+    def frontier_nodes(self):
+        """
+        Return the nodes at the frontier (entering in the latest frame
+        reached by any link).
+        """
+        # Nodes are added in time order, so these are at the end
+        nodes = []
+        for u in reversed(self.nodes):
+            if u.entry < self.frontier:
+                break
+            if u.entry == self.frontier and u.entries:
+                nodes.append(u)
+        nodes.reverse()
+        return nodes
+
+    def partial_hyp(self):
+        """
+        Return the best partial path, ending at the frontier.
+
+        @return: Nodes on the best path from the start to the frontier
+        @rtype: list of Dag.Node
+        """
+        best = None
+        for u in self.frontier_nodes():
+            if u.prev != None and (best == None or u.score > best.score):
+                best = u
+        if best == None:
+            return [self.start]
+        return self.backtrace(best)
+
+    def partial_posterior(self):
+        """
+        Compute link posterior probabilities given the audio so far,
+        i.e. over all paths from the start to the frontier.
+
+        @return: Normalizer (log-probability of all paths to the
+                 frontier)
+        @rtype: float
+        """
+        lm = self.lm
+        # Beta for links into the frontier = 1.0
+        for u in reversed(self.nodes):
+            for vx in u.exits:
+                if vx.dest.entry == self.frontier:
+                    vx.beta = 0
+                    continue
+                vx.beta = LOGZERO
+                if lm:
+                    lscr = lm.prob(symtab.basesym[vx.dest.wid],
+                                   symtab.basesym[u.wid])[0] * self.lw
+                else:
+                    lscr = 0
+                for wx in vx.dest.exits:
+                    vx.beta = logadd(vx.beta, wx.beta + lscr + wx.ascr * self.aw)
+        norm = LOGZERO
+        for u in self.frontier_nodes():
+            for vx in u.entries:
+                norm = logadd(norm, vx.alpha)
+        for u in self.nodes:
+            for x in u.exits:
+                x.post = x.alpha + x.beta - norm
+        return norm
+
+    def partial_result(self):
+        """
+        Return the best partial hypothesis annotated with confidences.
+
+        The confidence of each word is the posterior probability
+        (given the audio so far) of the link it was hypothesized on,
+        or for the last word (which has not yet ended), of all paths
+        reaching the frontier at a node for the same base word.
+
+        @return: Word, entry frame and posterior log-probability for
+                 each word (without fillers or sentence markers)
+        @rtype: list of (string, int, float)
+        """
+        path = self.partial_hyp()
+        if len(path) < 2:
+            return []
+        norm = self.partial_posterior()
+        result = []
+        for u, v in zip(path[:-1], path[1:]):
+            if symtab.filler[u.wid] or symtab.sentmark[u.wid]:
+                continue
+            post = max([x.post for x in u.exits if x.dest == v])
+            result.append((symtab.basesym[u.wid], u.entry, post))
+        last = path[-1]
+        if not (symtab.filler[last.wid] or symtab.sentmark[last.wid]):
+            post = LOGZERO
+            for u in self.frontier_nodes():
+                if symtab.base[u.wid] == symtab.base[last.wid]:
+                    for vx in u.entries:
+                        post = logadd(post, vx.alpha)
+            result.append((symtab.basesym[last.wid], last.entry, post - norm))
+        return result
+
+    def finish(self, end):
+        """
+        Mark the end of the utterance and compute final link posterior
+        probabilities (as in L{Dag.posterior}, but reusing the forward
+        probabilities already computed).
+
+        @param end: Final node (normally C{</s>} at the frontier)
+        @type end: Dag.Node
+        """
+        self.end = end
+        self.backward(self.lm, self.lw, self.aw)
+        norm = LOGZERO
+        for vx in self.end.entries:
+            norm = logadd(norm, vx.alpha)
+        for w in self.nodes:
+            for wx in w.exits:
+                wx.post = wx.alpha + wx.beta - norm
+
+class ConfusionNetwork(object):
+    """
+    Confusion network ("sausage") built from the link posterior
+    probabilities of a L{Dag}.
+
+    Each link in the lattice is assigned to one of a sequence of
+    non-overlapping, time-ordered slots.  The slots are the words of
+    a pivot path, usually the best path, plus extra slots for links
+    in gaps between them.  A link goes to the slot it overlaps the most
+    in time.  The posterior probabilities of links for the same base
+    word in a slot are summed.  The remaining probability mass goes to
+    a null word, C{<eps>}, which represents a deletion.  Filler words
+    and sentence markers are not included.
+
+    Slots are stored in flat arrays, with the words of slot C{i} in the
+    range C{slot_ptr[i]:slot_ptr[i+1]}, in order of decreasing
+    posterior probability, so the words around any time can be found in
+    logarithmic time.
+
+    @ivar slot_start: First frame of each slot
+    @type slot_start: numpy.ndarray of int32
+    @ivar slot_end: Frame after the end of each slot
+    @type slot_end: numpy.ndarray of int32
+    @ivar slot_ptr: Offset of the first word of each slot, plus a final
+                    offset equal to the number of words
+    @type slot_ptr: numpy.ndarray of int32
+    @ivar word_id: Symbol ID (in L{symtab}) of each word
+    @type word_id: numpy.ndarray of int32
+    @ivar word_post: Posterior log-probability of each word
+    @type word_post: numpy.ndarray of float64
+    """
+    EPSILON = '<eps>'
+
+    def __init__(self, dag, pivot=None):
+        """
+        Build a confusion network from a DAG.  Link posteriors must
+        already have been computed with L{Dag.posterior} (or
+        L{Dag.posterior_tg}).
+
+        @param dag: DAG to build confusion network from
+        @type dag: Dag
+        @param pivot: Path through C{dag} whose words define the
+                      initial slots (default is the path with the
+                      highest product of link posteriors)
+        @type pivot: list of Dag.Node
+        """
+        filler = symtab.filler
+        sentmark = symtab.sentmark
+        base = symtab.base
+        if pivot == None:
+            pivot = self.best_posterior_path(dag)
+        # Initial slots from the words in the pivot path
+        slots = []
+        for u, v in zip(pivot[:-1], pivot[1:]):
+            if not (filler[u.wid] or sentmark[u.wid]):
+                slots.append((u.entry, v.entry))
+        starts = [s for s, e in slots]
+        ends = [e for s, e in slots]
+        # Assign each link to the slot it overlaps the most
+        members = [[] for s in slots]
+        orphans = []
+        for u in dag.nodes:
+            if filler[u.wid] or sentmark[u.wid]:
+                continue
+            for x in u.exits:
+                s, e = u.entry, x.dest.entry
+                best = -1
+                overlap = 0
+                for i in range(bisect.bisect_right(ends, s),
+                               bisect.bisect_left(starts, e)):
+                    o = min(e, ends[i]) - max(s, starts[i])
+                    if o > overlap:
+                        best = i
+                        overlap = o
+                if best == -1:
+                    orphans.append((s, e, x))
+                else:
+                    members[best].append(x)
+        # Group links in gaps between slots into new slots
+        orphans.sort()
+        gaps = []
+        for s, e, x in orphans:
+            if gaps and s < gaps[-1][1]:
+                gaps[-1][1] = max(gaps[-1][1], e)
+                gaps[-1][2].append(x)
             else:
-                lscr = 0
-            # Accumulate alpha for this arc
-            wx.alpha = logadd(wx.alpha, vx.alpha + lscr + wx.ascr * aw)
+                gaps.append([s, e, [x]])
+        slots = zip(slots, members) + [((s, e), m) for s, e, m in gaps]
+        slots.sort()
+        # Sum posteriors for each base word in each slot
+        eps = symtab.intern(self.EPSILON)
+        slot_start = []
+        slot_end = []
+        slot_ptr = [0]
+        word_id = []
+        word_post = []
+        for (s, e), links in slots:
+            posts = {}
+            for x in links:
+                b = base[x.src.wid]
+                posts[b] = logadd(posts.get(b, LOGZERO), x.post)
+            total = LOGZERO
+            for p in posts.itervalues():
+                total = logadd(total, p)
+            if total > 0:
+                # Links on the same path landed in one slot
+                for b in posts:
+                    posts[b] -= total
+            elif 1 - math.exp(total) > 0:
+                posts[eps] = max(math.log(1 - math.exp(total)), LOGZERO)
+            words = posts.items()
+            words.sort(lambda x,y: cmp(y[1], x[1]))
+            slot_start.append(s)
+            slot_end.append(e)
+            for b, p in words:
+                word_id.append(b)
+                word_post.append(p)
+            slot_ptr.append(len(word_id))
+        self.slot_start = numpy.array(slot_start, 'i')
+        self.slot_end = numpy.array(slot_end, 'i')
+        self.slot_ptr = numpy.array(slot_ptr, 'i')
+        self.word_id = numpy.array(word_id, 'i')
+        self.word_post = numpy.array(word_post, 'd')
+
+    def best_posterior_path(dag):
+        """
+        Find the path through a DAG with the highest product of link
+        posterior probabilities.
+
+        @rtype: list of Dag.Node
+        """
+        score = {dag.start: 0}
+        prev = {}
+        for u in dag.topo_nodes():
+            if u not in score:
+                continue
+            for x in u.exits:
+                s = score[u] + x.post
+                if x.dest not in score or s > score[x.dest]:
+                    score[x.dest] = s
+                    prev[x.dest] = u
+        path = [dag.end]
+        while path[-1] in prev:
+            path.append(prev[path[-1]])
+        path.reverse()
+        return path
+    best_posterior_path = staticmethod(best_posterior_path)
+
+    def n_slots(self):
+        """
+        Return the number of slots in the confusion network.
+        @rtype: int
+        """
+        return len(self.slot_start)
+
+    def slot(self, i):
+        """
+        Return the words in a slot.
+
+        @param i: Slot index
+        @type i: int
+        @return: Words and their posterior log-probabilities, most
+                 probable first
+        @rtype: list of (string, float)
+        """
+        a, b = self.slot_ptr[i], self.slot_ptr[i+1]
+        return [(symtab.syms[w], float(p))
+                for w, p in zip(self.word_id[a:b], self.word_post[a:b])]
+
+    def find_slot(self, time):
+        """
+        Return the index of the slot containing a frame, or -1 if
+        there is none.
+        """
+        i = int(numpy.searchsorted(self.slot_start, time, 'right')) - 1
+        if i >= 0 and time < self.slot_end[i]:
+            return i
+        return -1
+
+    def slot_range(self, start, end):
+        """
+        Return the indices of the slots overlapping frames C{start} to
+        C{end - 1}.
+        @rtype: list of int
+        """
+        lo = int(numpy.searchsorted(self.slot_end, start, 'right'))
+        hi = int(numpy.searchsorted(self.slot_start, end, 'left'))
+        return range(lo, max(lo, hi))
+
+    def alternatives(self, start, end=None):
+        """
+        Return the alternative words around a point or in a range of
+        time.
+
+        @param start: First frame
+        @type start: int
+        @param end: Frame after the last frame (default is C{start + 1})
+        @type end: int
+        @return: Start frame, end frame and words with posterior
+                 log-probabilities (most probable first) for each slot
+        @rtype: list of (int, int, list of (string, float))
+        """
+        if end == None:
+            end = start + 1
+        return [(int(self.slot_start[i]), int(self.slot_end[i]), self.slot(i))
+                for i in self.slot_range(start, end)]
+
+    def consensus(self):
+        """
+        Return the consensus hypothesis, i.e. the most probable word
+        in each slot, leaving out slots where it is C{<eps>}.
+
+        @return: Word, start frame, end frame and posterior
+                 log-probability for each word
+        @rtype: list of (string, int, int, float)
+        """
+        eps = symtab.intern(self.EPSILON)
+        hyp = []
+        for i in range(self.n_slots()):
+            w = self.word_id[self.slot_ptr[i]]
+            if w != eps:
+                hyp.append((symtab.syms[w], int(self.slot_start[i]),
+                            int(self.slot_end[i]),
+                            float(self.word_post[self.slot_ptr[i]])))
+        return hyp
 
-def backward_tg(self, lm=None, lw=1.0, aw=1.0):
+def concat_ranges(starts, counts):
     """
-    Compute backward variable for all arcs in the lattice.
+    Return the concatenation of C{arange(s, s+c)} for all C{s, c} in
+    C{starts, counts}, without a Python loop.
 
-    @param lm: Language model to use in computation
-    @type lm: sphinxbase.ngram_model.NGramModel (or equivalent)
+    @param starts: Start of each range
+    @type starts: numpy.ndarray of int
+    @param counts: Length of each range
+    @type counts: numpy.ndarray of int
+    @rtype: numpy.ndarray of int
     """
-    for vx in self.reverse_edges_breadth():
-        # Beta for arcs into </s> = 1.0
-        if vx.dest == self.end:
-            vx.beta = 0
+    counts = numpy.asarray(counts)
+    total = counts.sum()
+    if total == 0:
+        return numpy.zeros(0, 'i')
+    offsets = numpy.cumsum(counts) - counts
+    return (numpy.repeat(numpy.asarray(starts) - offsets, counts)
+            + numpy.arange(total)).astype('i')
+
+class ArrayDag(object):
+    """
+    Compact array-backed representation of a phone/word lattice.
+
+    Unlike L{Dag}, which keeps a separate Python object for every node
+    and link, this stores the lattice in flat NumPy arrays.  Nodes are
+    sorted by entry frame, which is a topological order since every
+    edge moves forward in time.  Edges are sorted by source node and
+    then by the entry frame of their destination, so that the exits of
+    node C{u} are the contiguous range of edge IDs
+    C{exit_ptr[u]:exit_ptr[u+1]} (compressed sparse row format).  The
+    entries of node C{v} are the edge IDs
+    C{entry_idx[entry_ptr[v]:entry_ptr[v+1]]}.
+
+    @ivar symtab: Symbol table for node words
+    @type symtab: SymbolTable
+    @ivar syms: Word string for each symbol ID (same as C{symtab.syms})
+    @type syms: list of string
+    @ivar node_sym: Symbol ID for each node
+    @type node_sym: numpy.ndarray of int32
+    @ivar node_entry: Entry frame for each node
+    @type node_entry: numpy.ndarray of int32
+    @ivar exit_ptr: Offset of the first exit of each node, plus a
+                    final offset equal to the number of edges
+    @type exit_ptr: numpy.ndarray of int32
+    @ivar entry_ptr: Offset into C{entry_idx} of the first entry of
+                     each node, plus a final offset equal to the
+                     number of edges
+    @type entry_ptr: numpy.ndarray of int32
+    @ivar entry_idx: Edge IDs sorted by destination node
+    @type entry_idx: numpy.ndarray of int32
+    @ivar edge_src: Source node for each edge
+    @type edge_src: numpy.ndarray of int32
+    @ivar edge_dest: Destination node for each edge
+    @type edge_dest: numpy.ndarray of int32
+    @ivar edge_ascr: Acoustic score for each edge
+    @type edge_ascr: numpy.ndarray of float64
+    @ivar edge_lscr: Language model score for each edge (LOGZERO if
+                     not known)
+    @type edge_lscr: numpy.ndarray of float64
+    @ivar start: Index of the start node
+    @type start: int
+    @ivar end: Index of the end node
+    @type end: int
+    """
+    def __init__(self, sphinx_file=None, htk_file=None, dag=None, frate=100,
+                 binary_file=None):
+        """
+        Construct an array DAG, optionally loading contents from a
+        file or converting them from an existing L{Dag}.
+
+        @param sphinx_file: Sphinx-III format word lattice file to
+                            load (optionally).
+        @type sphinx_file: string
+        @param htk_file: HTK SLF format word lattice file to
+                         load (optionally).
+        @type htk_file: string
+        @param binary_file: Binary format word lattice file to
+                            memory-map (optionally).
+        @type binary_file: string
+        @param dag: Object-based lattice to convert (optionally).
+        @type dag: Dag
+        @param frate: Number of frames per second (see L{Dag.__init__})
+        @type frate: int
+        """
+        self.frate = frate
+        self.header = {}
+        self.getcwd = None
+        self.n_frames = 0
+        self.symtab = symtab
+        self.syms = symtab.syms
+        if sphinx_file != None:
+            self.sphinx2dag(sphinx_file)
+        elif htk_file != None:
+            self.htk2dag(htk_file)
+        elif binary_file != None:
+            self.binary2array(binary_file)
+        elif dag != None:
+            self.dag2array(dag)
+
+    def intern(self, sym):
+        """
+        Return the symbol ID for C{sym}, adding it to the symbol table
+        if necessary.
+        """
+        return self.symtab.intern(sym)
+
+    def _build(self, node_sym, node_entry, edge_src, edge_dest,
+               edge_ascr, edge_lscr, start, end):
+        """
+        Sort nodes and edges and construct the CSR index tables.  The
+        inputs are sequences indexed by the node IDs used in C{edge_src},
+        C{edge_dest}, C{start} and C{end}, in any order.
+        """
+        node_entry = numpy.asarray(node_entry, 'i')
+        # Sort nodes by starting point (stable, like Dag.sort_nodes_forward)
+        order = numpy.argsort(node_entry, kind='mergesort')
+        rank = numpy.empty(len(order), 'i')
+        rank[order] = numpy.arange(len(order))
+        self.node_sym = numpy.asarray(node_sym, 'i')[order]
+        self.node_entry = node_entry[order]
+        self.start = int(rank[start])
+        self.end = int(rank[end])
+        # Sort edges by source node, then by ending point
+        src = rank[numpy.asarray(edge_src, 'i')]
+        dest = rank[numpy.asarray(edge_dest, 'i')]
+        eorder = numpy.lexsort((self.node_entry[dest], src))
+        self.edge_src = src[eorder]
+        self.edge_dest = dest[eorder]
+        self.edge_ascr = numpy.asarray(edge_ascr, 'd')[eorder]
+        self.edge_lscr = numpy.asarray(edge_lscr, 'd')[eorder]
+        # Construct CSR offsets for exits and entries
+        nodeids = numpy.arange(len(order) + 1)
+        self.exit_ptr = numpy.searchsorted(self.edge_src, nodeids).astype('i')
+        self.entry_idx = numpy.argsort(self.edge_dest,
+                                       kind='mergesort').astype('i')
+        self.entry_ptr = numpy.searchsorted(self.edge_dest[self.entry_idx],
+                                            nodeids).astype('i')
+
+    fieldre = Dag.fieldre
+    def htk2dag(self, htkfile):
+        """Read an HTK-format lattice file to populate an array DAG."""
+        if htkfile.endswith('.gz'): # DUMB
+            fh = gzip.open(htkfile)
         else:
-            vx.beta = LOGZERO
-            # Get unscaled language model probability P(w|v) (bigrams only for now...)
-            if lm:
-                lscr = lm.prob(baseword(vx.dest.sym),
-                               baseword(vx.src.sym))[0] * lw
+            fh = open(htkfile)
+        self.header = {}
+        self.n_frames = 0
+        node_sym = node_entry = None
+        edge_src = []
+        edge_dest = []
+        edge_ascr = []
+        edge_lscr = []
+        state = 'header'
+        for spam in fh:
+            if spam.startswith('#'):
+                continue
+            fields = dict(map(lambda (x,y,z): (x, y or z), self.fieldre.findall(spam.rstrip())))
+            # Number of nodes and links
+            if 'N' in fields:
+                nnodes = int(fields['N'])
+                node_sym = [0] * nnodes
+                node_entry = [0] * nnodes
+                state = 'items'
+            if state == 'header':
+                self.header.update(fields)
+            else:
+                # This is a node
+                if 'I' in fields:
+                    nodeid = int(fields['I'])
+                    frame = int(float(fields['t']) * self.frate + 0.5)
+                    node_sym[nodeid] = self.intern(fields['W'])
+                    node_entry[nodeid] = frame
+                    if frame > self.n_frames:
+                        self.n_frames = frame
+                # This is a link
+                elif 'J' in fields:
+                    edge_src.append(int(fields['S']))
+                    edge_dest.append(int(fields['E']))
+                    edge_ascr.append(float(fields['a']))
+                    edge_lscr.append(float(fields['n']))
+        fh.close()
+        # FIXME: As in Dag.htk2dag, assume the first and last nodes
+        # are the start and end.
+        self._build(node_sym, node_entry, edge_src, edge_dest,
+                    edge_ascr, edge_lscr, 0, len(node_sym) - 1)
+
+    def sphinx2dag(self, s3file):
+        """Read a Sphinx-III format lattice file to populate an array DAG."""
+        lat = read_sphinx(s3file)
+        self.header = lat['header']
+        self.getcwd = lat['getcwd']
+        self.n_frames = lat['n_frames']
+        if self.getcwd == None:
+            self.getcwd = os.getcwd()
+        self._build([self.intern(word) for word in lat['words']],
+                    lat['entry'], lat['edge_src'], lat['edge_dest'],
+                    lat['edge_ascr'], [LOGZERO] * len(lat['edge_src']),
+                    lat['start'], lat['end'])
+
+    def dag2array(self, dag):
+        """
+        Populate this array DAG from an object-based L{Dag}.
+
+        @param dag: Lattice to convert
+        @type dag: Dag
+        """
+        self.frate = dag.frate
+        self.header = getattr(dag, 'header', {}).copy()
+        self.getcwd = getattr(dag, 'getcwd', None)
+        self.n_frames = getattr(dag, 'n_frames', 0)
+        nodeid = {}
+        for i, u in enumerate(dag.nodes):
+            nodeid[u] = i
+        edge_src = []
+        edge_dest = []
+        edge_ascr = []
+        edge_lscr = []
+        for x in dag.edges():
+            edge_src.append(nodeid[x.src])
+            edge_dest.append(nodeid[x.dest])
+            edge_ascr.append(x.ascr)
+            edge_lscr.append(x.lscr)
+        self._build([self.intern(u.sym) for u in dag.nodes],
+                    [u.entry for u in dag.nodes],
+                    edge_src, edge_dest, edge_ascr, edge_lscr,
+                    nodeid[dag.start], nodeid[dag.end])
+
+    # Arrays stored in binary lattice files, in order, with their types
+    binary_arrays = (('node_sym', '<i4'), ('node_entry', '<i4'),
+                     ('exit_ptr', '<i4'), ('entry_ptr', '<i4'),
+                     ('entry_idx', '<i4'), ('edge_src', '<i4'),
+                     ('edge_dest', '<i4'), ('edge_ascr', '<f8'),
+                     ('edge_lscr', '<f8'))
+    def array2binary(self, outfile):
+        """
+        Write this array DAG in binary lattice format.
+
+        The file begins with a fixed header giving the magic number
+        C{LATB}, the format version, the numbers of nodes and edges,
+        the number of frames, the start and end nodes, the frame rate,
+        the number of header arguments and the length of the text
+        block.  The text block contains the working directory, the
+        header arguments and values, and the symbol table, one per
+        line.  It is followed by the arrays in L{binary_arrays}, each
+        aligned to 8 bytes, so that they can be memory-mapped in
+        place by L{binary2array}.
+
+        @param outfile: File to write
+        @type outfile: string
+        """
+        # Write a symbol table local to this lattice, in an order which
+        # reproduces the same IDs when interned into a new table.
+        local = SymbolTable()
+        node_sym = numpy.array([local.intern(self.syms[s])
+                                for s in self.node_sym], '<i4')
+        lines = [self.getcwd or '']
+        for arg, val in self.header.iteritems():
+            lines.extend((arg, val))
+        lines.extend(local.syms)
+        text = "\n".join(lines)
+        fh = open(outfile, "wb")
+        fh.write(binary_header.pack(BINARY_MAGIC, BINARY_VERSION,
+                                    self.n_nodes(), self.n_edges(),
+                                    self.n_frames, self.start, self.end,
+                                    self.frate, len(self.header), len(text)))
+        fh.write(text)
+        pos = binary_header.size + len(text)
+        for name, dtype in self.binary_arrays:
+            if name == 'node_sym':
+                data = node_sym.tostring()
             else:
-                lscr = 0
-            # For each outgoing arc from vx.dest
-            for wx in vx.dest.exits:
-                # Accumulate beta for this arc
-                vx.beta = logadd(vx.beta, wx.beta + lscr + wx.ascr * aw)
+                data = getattr(self, name).astype(dtype).tostring()
+            fh.write('\0' * (-pos % 8))
+            pos += -pos % 8
+            fh.write(data)
+            pos += len(data)
+        fh.close()
+
+    def binary2array(self, binfile):
+        """
+        Memory-map a binary format lattice file to populate an array
+        DAG.  The node and edge arrays are read-only views of the
+        mapped file rather than copies.
+
+        @param binfile: File to load
+        @type binfile: string
+        """
+        fh = open(binfile, "rb")
+        try:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        (magic, version, nnodes, nedges, self.n_frames, self.start, self.end,
+         self.frate, nheader, textlen) = binary_header.unpack_from(buf)
+        if magic != BINARY_MAGIC:
+            raise ValueError("%s is not a binary lattice" % binfile)
+        if version != BINARY_VERSION:
+            raise ValueError("%s has unsupported binary lattice version %d"
+                             % (binfile, version))
+        pos = binary_header.size
+        lines = buf[pos:pos+textlen].split("\n")
+        self.getcwd = lines[0] or None
+        self.header = dict(zip(lines[1:1+nheader*2:2], lines[2:2+nheader*2:2]))
+        self.symtab = SymbolTable()
+        for sym in lines[1+nheader*2:]:
+            self.symtab.intern(sym)
+        self.syms = self.symtab.syms
+        pos += textlen
+        counts = {'node_sym': nnodes, 'node_entry': nnodes,
+                  'exit_ptr': nnodes + 1, 'entry_ptr': nnodes + 1}
+        for name, dtype in self.binary_arrays:
+            pos += -pos % 8
+            arr = numpy.frombuffer(buf, dtype, counts.get(name, nedges), pos)
+            setattr(self, name, arr)
+            pos += arr.nbytes
+        self._levels = None
+
+    def array2dag(self):
+        """
+        Convert this array DAG to an object-based L{Dag}.
+
+        @return: Lattice with the same nodes and edges as this one.
+        @rtype: Dag
+        """
+        dag = Dag(frate=self.frate)
+        dag.header = self.header.copy()
+        dag.getcwd = self.getcwd
+        dag.n_frames = self.n_frames
+        dag.nodes = [Dag.Node(self.syms[s], int(f), i)
+                     for i, (s, f) in enumerate(zip(self.node_sym,
+                                                    self.node_entry))]
+        for e in xrange(self.n_edges()):
+            src = dag.nodes[self.edge_src[e]]
+            dest = dag.nodes[self.edge_dest[e]]
+            link = Dag.Link(src, dest, float(self.edge_ascr[e]),
+                            float(self.edge_lscr[e]))
+            src.exits.append(link)
+            dest.entries.append(link)
+        dag.start = dag.nodes[self.start]
+        dag.end = dag.nodes[self.end]
+        return dag
+
+    def n_nodes(self):
+        """
+        Return the number of nodes in the DAG
+        @return: Number of nodes in the DAG
+        @rtype: int
+        """
+        return len(self.node_sym)
+
+    def n_edges(self):
+        """
+        Return the number of edges in the DAG
+        @return: Number of edges in the DAG
+        @rtype: int
+        """
+        return len(self.edge_src)
+
+    def nbytes(self):
+        """
+        Return the number of bytes used by the node and edge arrays.
+        @rtype: int
+        """
+        return sum([a.nbytes for a in (self.node_sym, self.node_entry,
+                                       self.exit_ptr, self.entry_ptr,
+                                       self.entry_idx, self.edge_src,
+                                       self.edge_dest, self.edge_ascr,
+                                       self.edge_lscr)])
+
+    def sym(self, u):
+        """
+        Return the word string for node C{u}.
+        @param u: Node index
+        @type u: int
+        @rtype: string
+        """
+        return self.syms[self.node_sym[u]]
+
+    def exits(self, u):
+        """
+        Return the IDs of all edges out of node C{u}.
+        @param u: Node index
+        @type u: int
+        @rtype: numpy.ndarray of int
+        """
+        return numpy.arange(self.exit_ptr[u], self.exit_ptr[u+1])
+
+    def entries(self, u):
+        """
+        Return the IDs of all edges into node C{u}.
+        @param u: Node index
+        @type u: int
+        @rtype: numpy.ndarray of int
+        """
+        return self.entry_idx[self.entry_ptr[u]:self.entry_ptr[u+1]]
+
+    def topo_levels(self):
+        """
+        Partition the nodes into topological levels.
+
+        The level of a node is the length of the longest path to it
+        from any node with no predecessors, so all predecessors of a
+        node lie in earlier levels.  The levels are computed once and
+        cached.  Raises ValueError if the lattice contains a cycle.
+
+        @return: List of tuples C{(nodes, in_edges, in_offsets,
+                 out_edges)}, one per level, where C{nodes} are the
+                 nodes in the level which have at least one entry,
+                 C{in_edges} are the concatenated entries of C{nodes}
+                 with segment offsets C{in_offsets}, and C{out_edges}
+                 are the exits of all nodes in the level.
+        @rtype: list of (numpy.ndarray, numpy.ndarray, numpy.ndarray,
+                numpy.ndarray)
+        """
+        if getattr(self, '_levels', None) != None:
+            return self._levels
+        n = self.n_nodes()
+        depth = numpy.zeros(n, 'i')
+        # Nodes entering in the same frame cannot be connected to each
+        # other, so they can be updated together.
+        if numpy.all(self.node_entry[self.edge_dest]
+                     > self.node_entry[self.edge_src]):
+            bounds = numpy.concatenate(([0],
+                                        numpy.flatnonzero(numpy.diff(self.node_entry)) + 1,
+                                        [n]))
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                counts = self.entry_ptr[a+1:b+1] - self.entry_ptr[a:b]
+                has_entries = counts > 0
+                if not has_entries.any():
+                    continue
+                ids = self.entry_idx[self.entry_ptr[a]:self.entry_ptr[b]]
+                offsets = (self.entry_ptr[a:b] - self.entry_ptr[a])[has_entries]
+                depth[a:b][has_entries] = numpy.maximum.reduceat(
+                    depth[self.edge_src[ids]], offsets) + 1
+        else:
+            # Some edge doesn't go forward in time, so entry frame
+            # order is not topological.  Use Kahn's algorithm (as in
+            # Dag.topo_nodes), a whole level at a time: a node is ready
+            # once all of its predecessors have been given a depth.
+            fan = self.entry_ptr[1:] - self.entry_ptr[:-1]
+            ready = numpy.flatnonzero(fan == 0)
+            level = 0
+            ndone = 0
+            while len(ready):
+                depth[ready] = level
+                ndone += len(ready)
+                dests = self.edge_dest[concat_ranges(self.exit_ptr[ready],
+                                                     self.exit_ptr[ready+1]
+                                                     - self.exit_ptr[ready])]
+                fan = fan - numpy.bincount(dests, minlength=n)
+                dests = numpy.unique(dests)
+                ready = dests[fan[dests] == 0]
+                level += 1
+            if ndone < n:
+                raise ValueError("Lattice contains a cycle")
+        # Group nodes by depth
+        order = numpy.argsort(depth, kind='mergesort').astype('i')
+        bounds = numpy.searchsorted(depth[order], numpy.arange(depth.max() + 2))
+        self._levels = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            nodes = order[a:b]
+            counts = self.entry_ptr[nodes+1] - self.entry_ptr[nodes]
+            nodes = nodes[counts > 0]
+            counts = counts[counts > 0]
+            in_edges = self.entry_idx[concat_ranges(self.entry_ptr[nodes], counts)]
+            in_offsets = (numpy.cumsum(counts) - counts).astype('i')
+            out_edges = concat_ranges(self.exit_ptr[order[a:b]],
+                                      self.exit_ptr[order[a:b]+1]
+                                      - self.exit_ptr[order[a:b]])
+            self._levels.append((nodes, in_edges, in_offsets, out_edges))
+        return self._levels
+
+    def edge_lmprob(self, lm=None, lw=1.0):
+        """
+        Return the scaled bigram log-probability P(dest|src) for each
+        edge, as used by L{forward} and L{backward}.
+
+        @param lm: Language model to use in computation
+        @type lm: sphinxbase.ngram_model (or equivalent)
+        @param lw: Language model weight
+        @type lw: float
+        @rtype: numpy.ndarray of float64
+        """
+        if lm == None:
+            return numpy.zeros(self.n_edges(), 'd')
+        # Look up each distinct pair of base words only once
+        base = self.symtab.arrays()[2][self.node_sym]
+        basesym = self.symtab.syms
+        pairs = {}
+        lscr = numpy.empty(self.n_edges(), 'd')
+        for e, (u, v) in enumerate(zip(base[self.edge_src],
+                                       base[self.edge_dest])):
+            if (u, v) not in pairs:
+                pairs[u, v] = lm.prob(basesym[v], basesym[u])[0] * lw
+            lscr[e] = pairs[u, v]
+        return lscr
+
+    def forward(self, lm=None, lw=1.0, aw=1.0, lmprob=None):
+        """
+        Compute forward variable for all arcs in the lattice, one
+        topological level at a time.
+
+        This computes the same quantity as L{Dag.forward}, except that
+        arcs which cannot be reached from the start node have an alpha
+        of LOGZERO rather than blocking their successors.
+
+        @param lm: Language model to use in computation
+        @type lm: sphinxbase.ngram_model (or equivalent)
+        @param lmprob: Precomputed output of L{edge_lmprob} (optional)
+        @type lmprob: numpy.ndarray
+        @return: Joint log-probability of all paths ending in each arc
+        @rtype: numpy.ndarray of float64
+        """
+        if lmprob is None:
+            lmprob = self.edge_lmprob(lm, lw)
+        ascr = self.edge_ascr * aw
+        alpha = numpy.empty(self.n_edges(), 'd')
+        alpha.fill(-numpy.inf)
+        # Log-probability of all paths entering each node
+        node_alpha = numpy.empty(self.n_nodes(), 'd')
+        node_alpha.fill(-numpy.inf)
+        node_alpha[self.start] = 0
+        for nodes, in_edges, in_offsets, out_edges in self.topo_levels():
+            if len(nodes):
+                node_alpha[nodes] = numpy.logaddexp.reduceat(
+                    alpha[in_edges] + lmprob[in_edges], in_offsets)
+            alpha[out_edges] = node_alpha[self.edge_src[out_edges]] + ascr[out_edges]
+        return numpy.maximum(alpha, LOGZERO)
+
+    def backward(self, lm=None, lw=1.0, aw=1.0, lmprob=None):
+        """
+        Compute backward variable for all arcs in the lattice, one
+        topological level at a time.
+
+        @param lm: Language model to use in computation
+        @type lm: sphinxbase.ngram_model (or equivalent)
+        @param lmprob: Precomputed output of L{edge_lmprob} (optional)
+        @type lmprob: numpy.ndarray
+        @return: Conditional log-probability of all paths following
+                 each arc
+        @rtype: numpy.ndarray of float64
+        """
+        if lmprob is None:
+            lmprob = self.edge_lmprob(lm, lw)
+        # Beta for arcs into </s> = 1.0
+        lmprob = lmprob.copy()
+        lmprob[self.entries(self.end)] = 0
+        ascr = self.edge_ascr * aw
+        beta = numpy.empty(self.n_edges(), 'd')
+        beta.fill(-numpy.inf)
+        # Log-probability of all paths leaving each node
+        node_beta = numpy.empty(self.n_nodes(), 'd')
+        node_beta.fill(-numpy.inf)
+        node_beta[self.end] = 0
+        for nodes, in_edges, in_offsets, out_edges in reversed(self.topo_levels()):
+            if len(out_edges):
+                # Exits of a level are contiguous runs per source node
+                src = self.edge_src[out_edges]
+                starts = numpy.flatnonzero(numpy.concatenate(([True], src[1:] != src[:-1])))
+                node_beta[src[starts]] = numpy.logaddexp.reduceat(
+                    beta[out_edges] + ascr[out_edges], starts)
+                node_beta[self.end] = 0
+            if len(in_edges):
+                beta[in_edges] = node_beta[self.edge_dest[in_edges]] + lmprob[in_edges]
+        return numpy.maximum(beta, LOGZERO)
+
+    def posterior(self, lm=None, lw=1.0, aw=1.0):
+        """
+        Compute arc posterior probabilities.
+
+        @param lm: Language model to use in computation
+        @type lm: sphinxbase.ngram_model.NGramModel (or equivalent)
+        @return: Forward, backward and posterior log-probabilities
+                 for each arc
+        @rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        """
+        lmprob = self.edge_lmprob(lm, lw)
+        alpha = self.forward(lm, lw, aw, lmprob)
+        beta = self.backward(lm, lw, aw, lmprob)
+        # Sum over alpha for arcs entering the end node to get normalizer
+        norm = numpy.logaddexp.reduce(alpha[self.entries(self.end)])
+        return alpha, beta, alpha + beta - norm
@@ -13,7 +13,8 @@ __author__ = "David Huggins-Daines <dhuggins@cs.cmu.edu>"
 # System imports
 import sys
 import os
-from socket import *      #import the socket library
+import re
+import time
 
 # GTK+ and GStreamer
 import pygtk
@@ -37,6 +38,10 @@ import gst
 import sphinxbase
 import pocketsphinx
 #import latticeui
+import resultserver
+
+# Command sent by game clients to log a line of results
+log_command = re.compile(r"echo '([^'\n]*)' >> log\.txt")
 
 class LiveDemo(object):
     def __init__(self,
@@ -93,7 +98,7 @@ class LiveDemo(object):
         # Bus signals etc
         bus = self.pipeline.get_bus()
         bus.add_signal_watch()
-    #    bus.connect('message::application', self.application_message)
+        bus.connect('message::application', self.application_message)
 
         self.pipeline.set_state(gst.STATE_PLAYING)
 
@@ -149,32 +154,26 @@ class LiveDemo(object):
 
 
 
-	#Establish Socket Connection 
-	HOST = ''    #we are the host
-	PORT = 5000    #arbitrary port not currently in use
-	ADDR = (HOST,PORT)    #we need a tuple for the address
-	BUFSIZE = 4096    #reasonably sized buffer for data
- 
-	## now we create a new socket object (serv)
-	## see the python docs for more information on the socket types/flags
-	serv = socket(AF_INET,SOCK_STREAM)
- 
-	##bind our socket to the address
-	serv.bind((ADDR))    #the double parens are to create a tuple with one element
-	serv.listen(5)    #5 is the maximum number of queued connections we'll allow
-	print 'listening...'
- 
-	self.conn,addr = serv.accept() #accept the connection
-	print '...connected!'
-	#keep looping, start the recognizer loop when you receive "start", pause when you receive "pause" and close connection if you receive "stop"
-	while(1):
-		self.data=self.conn.recv(BUFSIZE)
-		if self.data.find('echo')!=-1:
-			os.system(self.data)
-	#	if self.data == "stop":
-   	#		print  "Done!"
-	#		self.conn.close()
-	
+        # Accept commands from, and send results to, any number of
+        # game clients on this machine without blocking the main loop
+        self.server = resultserver.ResultServer(5000, self.client_command)
+        self.partials = resultserver.PartialStreamer(self.server, 20.0)
+        print 'listening...'
+
+    def client_command(self, client, data):
+        """
+        Handle a command received from a game client.  The only
+        command is C{echo 'text' >> log.txt}, which the game uses to
+        log its results, and which is carried out here rather than
+        being passed to the shell.
+        """
+        lines = log_command.findall(data)
+        if lines:
+            log = open('log.txt', 'a')
+            for line in lines:
+                log.write(line + '\n')
+            log.close()
+
     def open_lattice(self, latfile):
         self.lat_folder = os.path.dirname(latfile)
         self.dag = pocketsphinx.Lattice(self.ps, latfile)
@@ -229,21 +228,38 @@ class LiveDemo(object):
 #            self.pipeline.set_state(gst.STATE_PAUSED)
 
     def application_message(self, bus, msg):
-	print 'application message ....'
+        """
+        Handle messages forwarded on the bus, in the main thread.
+        """
         msgtype = msg.structure.get_name()
         if msgtype == 'partial_result':
-            self.model.set_hyp([latticeui.LatticeWord(w, 0.0, 0.0)
-                                for w in msg.structure['hyp'].split()])
-            self.result.update_model()
+            self.partials.update(msg.structure['hyp'], msg.structure['uttid'])
+            #self.model.set_hyp([latticeui.LatticeWord(w, 0.0, 0.0)
+            #                    for w in msg.structure['hyp'].split()])
+            #self.result.update_model()
         elif msgtype == 'result':
+            print msg.structure['hyp']
+            # Send the hypothesis to the game clients, after the
+            # latest partial result
+            self.partials.reset()
+            self.server.broadcast_message('result',
+                                          hyp=msg.structure['hyp'],
+                                          uttid=msg.structure['uttid'])
             # Get the lattice
-            self.model.set_dag(self.dag)
-            self.result.update_model()
-            self.window.set_title(msg.structure['uttid'])
+            #self.model.set_dag(self.dag)
+            #self.result.update_model()
+            #self.window.set_title(msg.structure['uttid'])
+        elif msgtype == 'vader_start':
+            self.server.broadcast_message('timing', event='speech_start',
+                                          time=time.time())
         elif msgtype == 'vader_stop':
-            self.pipeline.set_state(gst.STATE_PAUSED)
-            self.button.set_label("Speak")
-            self.button.set_active(False)
+            self.server.broadcast_message('timing', event='speech_end',
+                                          time=time.time())
+            # There is no push to talk button, so keep listening
+            #self.pipeline.set_state(gst.STATE_PAUSED)
+            #self.button.set_label("Speak")
+            #self.button.set_active(False)
+            pass
 
     def queue_overrun(self, queue):
         """
@@ -287,9 +303,6 @@ class LiveDemo(object):
         """
         Forward partial result signals on the bus to the main thread.
         """
-	#print text
-	#send the hypothesis on the socket connection
-	#self.conn.send(text)
         struct = gst.Structure('partial_result')
         struct.set_value('hyp', text)
         struct.set_value('uttid', uttid)
@@ -299,9 +312,6 @@ class LiveDemo(object):
         """
         Forward result signals on the bus to the main thread.
         """
-	print text
-	#send the hypothesis on the socket connection
-	self.conn.send(text)
         struct = gst.Structure('result')
         struct.set_value('hyp', text)
         struct.set_value('uttid', uttid)
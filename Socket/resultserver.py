@@ -0,0 +1,482 @@
+# Copyright (c) 2007 Carnegie Mellon University
+#
+# You may copy and modify this freely under the same terms as
+# Sphinx-III
+
+"""
+Event-driven socket server for sending recognition results to game
+clients.
+
+Accepts any number of concurrent connections (such as the Flash
+C{SockConnection} class) and dispatches the commands they send,
+without ever blocking, by registering its sockets as GLib main loop
+sources.  Data sent to each client goes into a bounded queue which is
+written out as the client is ready to receive it, so a slow client
+never holds up the recognizer or the other clients.  The server must
+therefore be used from a program which runs the GLib (or GTK+) main
+loop.  Apart from L{ResultServer.broadcast} and
+L{ResultServer.broadcast_message}, which pass data sent from other
+threads to the main loop, it must only be used from the main loop
+thread, for example::
+
+    server = ResultServer(5000, handle_command)
+    gtk.main()
+
+Commands from clients are read as they arrive, but messages to
+clients are framed, so that they can be streamed at a high rate
+without being merged or split by TCP.  Each message is a JSON object
+with a C{type} field (one of L{MESSAGE_TYPES}), encoded in UTF-8 and
+preceded by its length in bytes as a 32-bit big-endian unsigned
+integer (see L{encode}).  Whatever messages are waiting for a client
+are written to it together.
+"""
+
+__author__ = "David Huggins-Daines <dhuggins@cs.cmu.edu>"
+
+import socket
+import errno
+import collections
+import struct
+import json
+import time
+import threading
+
+import gobject
+
+# Types of message sent to clients: partial and final hypotheses (with
+# C{hyp} and C{uttid} fields), word confidences (with C{uttid} and
+# C{words}, a list of [word, start time, end time, posterior]) and
+# timing events (with C{event} and C{time} fields).
+MESSAGE_TYPES = ('partial', 'result', 'confidence', 'timing')
+
+# Types of message which may be dropped when a client falls behind
+DROPPABLE_TYPES = ('partial', 'timing')
+
+frame_header = struct.Struct('>I')
+
+def encode(msgtype, **fields):
+    """
+    Encode a message to a client as a frame.
+
+    @param msgtype: Type of message (one of L{MESSAGE_TYPES})
+    @type msgtype: string
+    @param fields: Contents of the message
+    @return: Length-prefixed JSON encoding of the message
+    @rtype: string
+    """
+    if msgtype not in MESSAGE_TYPES:
+        raise ValueError("Unknown message type %s" % msgtype)
+    fields['type'] = msgtype
+    # This is pure ASCII, and thus also UTF-8
+    payload = json.dumps(fields, separators=(',', ':'))
+    return frame_header.pack(len(payload)) + payload
+
+def decode(data):
+    """
+    Decode all complete frames at the start of some data.
+
+    @param data: Data received from the server
+    @type data: string
+    @return: Decoded messages and any data left over
+    @rtype: (list of dict, string)
+    """
+    messages = []
+    pos = 0
+    while len(data) - pos >= frame_header.size:
+        length, = frame_header.unpack_from(data, pos)
+        end = pos + frame_header.size + length
+        if end > len(data):
+            break
+        messages.append(json.loads(data[pos + frame_header.size:end]))
+        pos = end
+    return messages, data[pos:]
+
+class Client(object):
+    """
+    Connection to a single client.
+
+    @ivar server: Server which accepted this connection
+    @type server: ResultServer
+    @ivar sock: Socket for this connection
+    @type sock: socket.socket
+    @ivar addr: Address of the client
+    @type addr: (string, int)
+    @ivar outq: Queue of C{[key, data, droppable]} waiting to be sent
+    @type outq: collections.deque
+    @ivar outbuf: Data taken from C{outq} but not yet sent (refilled
+                  only once it has all been sent)
+    @type outbuf: string
+    @ivar dropped: Number of items dropped because the queue was full
+    @type dropped: int
+    """
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.outq = collections.deque()
+        self.outbuf = ''
+        self.dropped = 0
+        self.out_watch = None
+        self.sock.setblocking(0)
+        self.watch = gobject.io_add_watch(self.sock,
+                                          gobject.IO_IN | gobject.IO_ERR
+                                          | gobject.IO_HUP,
+                                          self.on_readable)
+
+    def on_readable(self, source, condition):
+        """
+        Read and dispatch commands from the client when its socket
+        becomes readable (main loop callback).
+        """
+        if condition & gobject.IO_IN:
+            try:
+                data = self.sock.recv(self.server.bufsize)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return True
+                data = ''
+            if data:
+                self.server.dispatch(self, data)
+                return True
+        # End of file, hangup or error
+        self.watch = None
+        self.close()
+        return False
+
+    def send(self, data, key=None, droppable=None):
+        """
+        Queue data to be sent to the client.
+
+        If the queue is full, the server's C{overflow} policy decides
+        what happens: C{'drop_oldest'} discards the oldest droppable
+        item waiting, C{'drop_newest'} discards C{data} if it is
+        droppable, and C{'close'} closes the connection.  Items which
+        are not droppable (such as final results) are never discarded:
+        if there is no droppable item to discard, the connection is
+        closed instead.  Items which have started to be sent are no
+        longer in the queue.
+
+        @param data: Data to send
+        @type data: string
+        @param key: If not None, any item with the same key which is
+                    still waiting in the queue is replaced by this one
+                    (for example, an out of date partial result)
+        @type key: object
+        @param droppable: Whether this item may be discarded if the
+                          client falls behind (default is true only if
+                          C{key} is given)
+        @type droppable: bool
+        """
+        if self.sock == None:
+            return
+        if droppable == None:
+            droppable = key != None
+        if key != None:
+            for i, item in enumerate(self.outq):
+                if item[0] == key:
+                    del self.outq[i]
+                    break
+        if len(self.outq) >= self.server.maxqueue:
+            policy = self.server.overflow
+            victim = None
+            if policy == 'drop_newest' and droppable:
+                self.drop('newest item')
+                return
+            elif policy == 'drop_oldest':
+                for i, item in enumerate(self.outq):
+                    if item[2]:
+                        victim = i
+                        break
+                if victim == None and droppable:
+                    self.drop('newest item')
+                    return
+            if victim == None:
+                print 'queue full, closing: %s:%d' % self.addr
+                self.close()
+                return
+            del self.outq[victim]
+            self.drop('oldest droppable item')
+        self.outq.append([key, data, droppable])
+        if self.out_watch == None:
+            self.out_watch = gobject.io_add_watch(self.sock, gobject.IO_OUT,
+                                                  self.on_writable)
+
+    def on_writable(self, source, condition):
+        """
+        Send as much queued data as the client will accept when its
+        socket becomes writable (main loop callback).
+        """
+        # Send everything waiting at once, rather than making a system
+        # call for each item, but only once the last batch has gone, so
+        # that anything the client is not ready for stays in the queue
+        # where it can be replaced or dropped
+        if not self.outbuf:
+            self.outbuf = ''.join([item[1] for item in self.outq])
+            self.outq.clear()
+        try:
+            n = self.sock.send(self.outbuf)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return True
+            self.out_watch = None
+            self.close()
+            return False
+        self.outbuf = self.outbuf[n:]
+        if self.outbuf or self.outq:
+            return True
+        self.out_watch = None
+        return False
+
+    def drop(self, what):
+        """
+        Count and log an item dropped because the queue was full.
+        """
+        self.dropped += 1
+        print 'queue full, dropped %s: %s:%d (%d dropped)' \
+            % ((what,) + self.addr + (self.dropped,))
+
+    def send_message(self, msgtype, key=None, **fields):
+        """
+        Queue a message to be sent to the client.  Only messages of
+        the types in L{DROPPABLE_TYPES} are dropped if the client
+        falls behind.
+
+        @param msgtype: Type of message (one of L{MESSAGE_TYPES})
+        @type msgtype: string
+        @param key: Key for replacing queued items (see L{send})
+        @type key: object
+        @param fields: Contents of the message
+        """
+        self.send(encode(msgtype, **fields), key, msgtype in DROPPABLE_TYPES)
+
+    def close(self):
+        """
+        Close the connection and remove it from the server.
+        """
+        if self.sock == None:
+            return
+        if self.watch != None:
+            gobject.source_remove(self.watch)
+            self.watch = None
+        if self.out_watch != None:
+            gobject.source_remove(self.out_watch)
+            self.out_watch = None
+        self.outq.clear()
+        self.outbuf = ''
+        self.sock.close()
+        self.sock = None
+        self.server.remove(self)
+
+class ResultServer(object):
+    """
+    Server accepting connections from any number of clients.
+
+    @ivar clients: Currently connected clients
+    @type clients: list of Client
+    @ivar handler: Function called as C{handler(client, data)} with
+                   data received from each client
+    @type handler: callable
+    @ivar bufsize: Maximum amount of data to read at once
+    @type bufsize: int
+    @ivar maxqueue: Maximum number of items queued for each client
+    @type maxqueue: int
+    @ivar overflow: What to do when a client's queue is full (see
+                    L{Client.send})
+    @type overflow: string
+    @ivar thread: Thread running the main loop (the one which created
+                  the server)
+    @type thread: threading.Thread
+    """
+    def __init__(self, port=5000, handler=None, host='127.0.0.1', backlog=5,
+                 bufsize=4096, maxqueue=64, overflow='drop_oldest'):
+        """
+        Start listening for connections.
+
+        @param port: Port to listen on
+        @type port: int
+        @param handler: Function called as C{handler(client, data)}
+                        with data received from each client
+        @type handler: callable
+        @param host: Address to listen on (default is the local
+                     machine only; use C{''} for all interfaces)
+        @type host: string
+        @param backlog: Maximum number of queued connections
+        @type backlog: int
+        @param bufsize: Maximum amount of data to read at once
+        @type bufsize: int
+        @param maxqueue: Maximum number of items queued for each client
+        @type maxqueue: int
+        @param overflow: What to do when a client's queue is full,
+                         one of C{'drop_oldest'}, C{'drop_newest'} or
+                         C{'close'} (see L{Client.send})
+        @type overflow: string
+        """
+        if overflow not in ('drop_oldest', 'drop_newest', 'close'):
+            raise ValueError("Unknown overflow policy %s" % overflow)
+        self.handler = handler
+        self.bufsize = bufsize
+        self.maxqueue = maxqueue
+        self.overflow = overflow
+        self.thread = threading.currentThread()
+        self.clients = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(backlog)
+        self.sock.setblocking(0)
+        self.watch = gobject.io_add_watch(self.sock, gobject.IO_IN,
+                                          self.on_accept)
+
+    def on_accept(self, source, condition):
+        """
+        Accept a new connection (main loop callback).
+        """
+        try:
+            sock, addr = self.sock.accept()
+        except socket.error:
+            return True
+        self.clients.append(Client(self, sock, addr))
+        print 'connected: %s:%d' % addr
+        return True
+
+    def dispatch(self, client, data):
+        """
+        Pass data received from a client to the handler.
+        """
+        if self.handler:
+            self.handler(client, data)
+
+    def remove(self, client):
+        """
+        Forget about a client whose connection has been closed.
+        """
+        if client in self.clients:
+            self.clients.remove(client)
+            print 'disconnected: %s:%d' % client.addr
+
+    def broadcast(self, data, key=None, droppable=None):
+        """
+        Queue data to be sent to all connected clients.  If this is
+        called from a thread other than the main loop (such as a
+        GStreamer streaming thread), the data is queued from the main
+        loop when it is next idle.
+
+        @param data: Data to send
+        @type data: string
+        @param key: Key for replacing queued items (see L{Client.send})
+        @type key: object
+        @param droppable: Whether the data may be discarded for clients
+                          which fall behind (see L{Client.send})
+        @type droppable: bool
+        """
+        if threading.currentThread() is not self.thread:
+            gobject.idle_add(self.broadcast, data, key, droppable)
+            return
+        # Sending may close (and remove) clients
+        for client in self.clients[:]:
+            client.send(data, key, droppable)
+
+    def broadcast_message(self, msgtype, key=None, **fields):
+        """
+        Queue a message to be sent to all connected clients.
+
+        @param msgtype: Type of message (one of L{MESSAGE_TYPES})
+        @type msgtype: string
+        @param key: Key for replacing queued items (see L{Client.send})
+        @type key: object
+        @param fields: Contents of the message
+        """
+        self.broadcast(encode(msgtype, **fields), key,
+                       msgtype in DROPPABLE_TYPES)
+
+    def close(self):
+        """
+        Close all connections and stop listening.
+        """
+        for client in self.clients[:]:
+            client.close()
+        gobject.source_remove(self.watch)
+        self.sock.close()
+
+class PartialStreamer(object):
+    """
+    Rate-limited sender of partial results.
+
+    The decoder produces a partial hypothesis for nearly every frame,
+    usually the same as the last one.  This sends a partial result to
+    all clients only when the text changes, and no more than C{rate}
+    times per second, sending the latest text when the interval is up.
+    Partial results still waiting to be sent to a slow client are
+    replaced by newer ones (see L{Client.send}).
+
+    @ivar server: Server to send partial results through
+    @type server: ResultServer
+    @ivar interval: Minimum time between partial results in seconds
+    @type interval: float
+    """
+    def __init__(self, server, rate=20.0):
+        """
+        @param server: Server to send partial results through
+        @type server: ResultServer
+        @param rate: Maximum number of partial results per second
+        @type rate: float
+        """
+        self.server = server
+        self.interval = 1.0 / rate
+        self.last_sent = 0
+        self.sent_hyp = None
+        self.pending = None
+        self.timer = None
+
+    def update(self, hyp, uttid):
+        """
+        Note a new partial hypothesis, sending it if enough time has
+        passed since the last one.
+
+        @param hyp: Partial hypothesis
+        @type hyp: string
+        @param uttid: Utterance ID
+        @type uttid: string
+        """
+        if hyp == self.sent_hyp:
+            self.pending = None
+            return
+        self.pending = (hyp, uttid)
+        wait = self.last_sent + self.interval - time.time()
+        if wait <= 0:
+            self.flush()
+        elif self.timer == None:
+            self.timer = gobject.timeout_add(int(wait * 1000) + 1,
+                                             self.on_timeout)
+
+    def on_timeout(self):
+        """
+        Send the latest partial hypothesis (main loop callback).
+        """
+        self.timer = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """
+        Send the latest partial hypothesis now, if it has not been
+        sent.  This should be done before sending a final result.
+        """
+        if self.timer != None:
+            gobject.source_remove(self.timer)
+            self.timer = None
+        if self.pending == None:
+            return
+        hyp, uttid = self.pending
+        self.pending = None
+        self.server.broadcast_message('partial', key='partial',
+                                      hyp=hyp, uttid=uttid)
+        self.sent_hyp = hyp
+        self.last_sent = time.time()
+
+    def reset(self):
+        """
+        Send any waiting partial hypothesis and start a new utterance.
+        """
+        self.flush()
+        self.sent_hyp = None